@@ -0,0 +1,245 @@
+"""Estimate the cost of a generator configuration before training it.
+
+Parameter count, FLOPs and activation memory follow analytically from the layers of
+a built model; the step time is extrapolated from a short micro-benchmark.
+"""
+
+# Copyright (c) 2022 MeteoSwiss, contributors listed in AUTHORS
+# Distributed under the terms of the BSD 3-Clause License.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Standard library
+import math
+import time
+
+# Third-party
+import numpy as np
+import tensorflow as tf  # type: ignore
+from keras import layers
+
+# First-party
+from aldernet.training_utils import build_gan_step
+from aldernet.training_utils import Recompute
+from aldernet.training_utils import SpectralNormalization
+
+
+def _elements(shape):
+    """Number of elements per sample of a (batched) shape or list of shapes."""
+    if isinstance(shape, list):
+        return sum(_elements(single) for single in shape)
+    return math.prod(shape[1:])
+
+
+def _bytes(layer, shape):
+    return _elements(shape) * tf.as_dtype(layer.compute_dtype).size
+
+
+def leaf_layers(layer):
+    """Yield the layers without sublayers in ``layer``, in order."""
+    sublayers = getattr(layer, "layers", None)
+    if sublayers is None:
+        yield layer
+        return
+    for sublayer in sublayers:
+        if not isinstance(sublayer, layers.InputLayer):
+            yield from leaf_layers(sublayer)
+
+
+def layer_flops(layer):
+    """Forward FLOPs per sample of a leaf layer, a multiply-add counting as two.
+
+    Layers that only move data (padding, cropping, concatenation, ...) are free.
+    The FLOPs of a ``layers.Wrapper`` are those of the layer it wraps.
+    """
+    inputs = _elements(layer.input_shape)
+    outputs = _elements(layer.output_shape)
+    channels = layer.input_shape[-1]
+    if isinstance(layer, layers.Wrapper):
+        # Only the wrapper has shapes, its layer is called inside it
+        layer = layer.layer
+    if isinstance(layer, layers.SeparableConv2D):
+        spatial = outputs // layer.filters
+        channels *= layer.depth_multiplier
+        flops = 2 * spatial * channels * (math.prod(layer.kernel_size) + layer.filters)
+    elif isinstance(layer, layers.DepthwiseConv2D):
+        flops = 2 * outputs * math.prod(layer.kernel_size)
+    elif isinstance(layer, layers.Conv2DTranspose):
+        # Every input pixel scatters a kernel into the output
+        flops = 2 * inputs * math.prod(layer.kernel_size) * layer.filters
+    elif isinstance(layer, layers.Conv2D):
+        flops = 2 * outputs * math.prod(layer.kernel_size) * channels
+    elif isinstance(layer, layers.Dense):
+        flops = 2 * outputs * channels
+    elif isinstance(layer, layers.BatchNormalization):
+        return 4 * outputs
+    elif isinstance(layer, (layers.LeakyReLU, layers.ReLU, layers.Activation)):
+        return outputs
+    else:
+        return 0
+    if getattr(layer, "use_bias", False):
+        flops += outputs
+    if getattr(layer, "activation", None) not in (None, tf.keras.activations.linear):
+        flops += outputs
+    return flops
+
+
+def _inference_peak(layer):
+    """Memory held while running ``layer`` beyond its inputs, per sample.
+
+    Within a block only consecutive layers are alive at the same time.
+    """
+    leaves = list(leaf_layers(layer))
+    peak = 0
+    for index, leaf in enumerate(leaves):
+        held = _bytes(leaf, leaf.output_shape)
+        if index > 0:
+            held += _bytes(leaf, leaf.input_shape)
+        peak = max(peak, held)
+    return peak
+
+
+def model_cost(model):
+    """Return the analytic cost of a functional ``model`` per sample.
+
+    * ``params``: number of weights, without the power iteration vectors and cached
+      kernels of ``SpectralNormalization``, which are state rather than parameters
+    * ``flops``, ``flops_train``: FLOPs of a forward pass and of a training step,
+      whose backward pass costs two forward passes, plus the forward pass of the
+      ``Recompute`` blocks
+    * ``activations``, ``activations_train``: peak activation bytes for inference,
+      where tensors are freed after their last use, and for training, where every
+      activation is kept for the backward pass except inside ``Recompute`` blocks
+    * ``weights``, ``optimizer``: bytes of the weights, and of the gradients and
+      Adam moments of the trainable ones
+    """
+    flops = 0
+    recomputed_flops = 0
+    stored = 0
+    transient = 0
+    for layer in model.layers:
+        leaves = list(leaf_layers(layer))
+        block_flops = sum(layer_flops(leaf) for leaf in leaves)
+        flops += block_flops
+        if isinstance(layer, Recompute):
+            # Only the block's output is kept; its activations are rebuilt one block
+            # at a time in the backward pass
+            recomputed_flops += block_flops
+            stored += _bytes(layer, layer.output_shape)
+            transient = max(
+                transient,
+                sum(_bytes(leaf, leaf.output_shape) for leaf in leaves),
+            )
+        else:
+            stored += sum(_bytes(leaf, leaf.output_shape) for leaf in leaves)
+
+    # Free each top-level output after the last layer consuming it
+    last_use = {}
+    for index, layer in enumerate(model.layers):
+        for node in layer.inbound_nodes:
+            for inbound in tf.nest.flatten(node.inbound_layers):
+                last_use[inbound.name] = index
+    live = {}
+    peak = 0
+    for index, layer in enumerate(model.layers):
+        if isinstance(layer, layers.InputLayer):
+            live[layer.name] = _bytes(layer, layer.output_shape)
+            continue
+        peak = max(peak, sum(live.values()) + _inference_peak(layer))
+        live[layer.name] = _bytes(layer, layer.output_shape)
+        for name in [name for name in live if last_use.get(name, index) <= index]:
+            # Keep the model outputs
+            if name not in model.output_names:
+                del live[name]
+    peak = max(peak, sum(live.values()))
+
+    buffers = {
+        id(variable)
+        for layer in model.submodules
+        if isinstance(layer, SpectralNormalization)
+        for variable in (layer.u, layer.kernel_normalized)
+    }
+    trainable = sum(
+        variable.shape.num_elements() * variable.dtype.size
+        for variable in model.trainable_weights
+    )
+    return {
+        "params": sum(
+            variable.shape.num_elements()
+            for variable in model.weights
+            if id(variable) not in buffers
+        ),
+        "flops": flops,
+        "flops_train": 3 * flops + recomputed_flops,
+        "activations": peak,
+        "activations_train": stored + transient,
+        "weights": sum(
+            variable.shape.num_elements() * variable.dtype.size
+            for variable in model.weights
+        ),
+        "optimizer": 3 * trainable,
+    }
+
+
+def peak_memory(cost, batch_size, training=True):
+    """Estimate the peak memory in bytes of one device for ``batch_size`` samples."""
+    if training:
+        return (
+            batch_size * cost["activations_train"] + cost["weights"] + cost["optimizer"]
+        )
+    return batch_size * cost["activations"] + cost["weights"]
+
+
+def benchmark_step(generator, batch_size=2, steps=3, jit_compile=False):
+    """Time the compiled training step of a copy of ``generator`` in seconds.
+
+    The first step, which traces the function, is not timed.
+    """
+    model = tf.keras.models.clone_model(generator)
+    shapes = {tensor.name: tensor.shape for tensor in model.inputs}
+    noise_dim = shapes["noise_input"][-1] if "noise_input" in shapes else 0
+    add_weather = "weather_input" in shapes
+    step = build_gan_step(
+        model,
+        tf.keras.optimizers.Adam(),
+        noise_dim,
+        add_weather,
+        batch_size=batch_size,
+        jit_compile=jit_compile,
+    )
+    rng = np.random.default_rng(0)
+    batch = [
+        rng.normal(size=(batch_size, *shapes["image_input"][1:])),
+        rng.normal(size=(batch_size, *model.output_shape[1:])),
+    ]
+    if add_weather:
+        batch.append(rng.normal(size=(batch_size, *shapes["weather_input"][1:])))
+    batch = [tf.constant(array, tf.float32) for array in batch]
+    step(*batch).numpy()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step(*batch).numpy()
+    return (time.perf_counter() - start) / steps
+
+
+def estimate_cost(generator, batch_size=32, benchmark_batch=None, steps=3, **kwargs):
+    """Estimate the cost of training ``generator`` with batches of ``batch_size``.
+
+    Extends ``model_cost`` with the peak ``memory`` and ``memory_inference`` for the
+    batch, and with the ``step_time`` in seconds: the throughput in FLOP/s of a
+    training step with ``benchmark_batch`` samples, timed by ``benchmark_step`` on
+    this device, is taken to hold for the full batch. Without a ``benchmark_batch``
+    the step time is not estimated. The ``kwargs`` go to ``benchmark_step``.
+
+    TensorFlow keeps the memory of the benchmark allocated, so do not time steps
+    in a process that shares its device with the training.
+    """
+    cost = model_cost(generator)
+    cost["memory"] = peak_memory(cost, batch_size)
+    cost["memory_inference"] = peak_memory(cost, batch_size, training=False)
+    if benchmark_batch:
+        seconds = benchmark_step(
+            generator, batch_size=benchmark_batch, steps=steps, **kwargs
+        )
+        cost["throughput"] = cost["flops_train"] * benchmark_batch / seconds
+        cost["step_time"] = cost["flops_train"] * batch_size / cost["throughput"]
+    return cost
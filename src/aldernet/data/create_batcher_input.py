@@ -6,6 +6,9 @@
 import numpy as np
 import xarray as xr
 
+# First-party
+from aldernet.data.data_utils import pack_channels
+
 select_params = [
     "ALNU",
     "CORY",
@@ -45,14 +48,21 @@ data_zoom = data_select
 # print(np.argwhere(np.isnan(data_zoom.to_array().to_numpy())))
 data_zoom = data_zoom.interpolate_na(dim="x", method="linear", fill_value="extrapolate")
 
-high_indices = (
-    (
-        (data_zoom["CORY"].mean(dim=("x", "y")) > 5)
-        | (data_zoom["ALNU"].mean(dim=("x", "y")) > 5)
-    )
-    & (data_zoom["CORY"].max(dim=("x", "y")) < 5000)
-    & (data_zoom["ALNU"].max(dim=("x", "y")) < 5000)
+# Keep all timesteps and let Batcher(importance_exponent=...) draw high-pollen ones
+# more often, instead of dropping everything below the threshold
+importance_sampling = False
+
+# Per-timestep statistics in grains/m3, stored for the importance sampler
+pollen_mean = np.maximum(
+    data_zoom["CORY"].mean(dim=("x", "y")), data_zoom["ALNU"].mean(dim=("x", "y"))
+).compute()
+data_zoom = data_zoom.assign_coords(pollen_mean=pollen_mean)
+
+high_indices = (data_zoom["CORY"].max(dim=("x", "y")) < 5000) & (
+    data_zoom["ALNU"].max(dim=("x", "y")) < 5000
 )
+if not importance_sampling:
+    high_indices = high_indices & (pollen_mean > 5)
 
 data_high = data_zoom.sel({"valid_time": data_zoom.valid_time[high_indices]})
 
@@ -74,3 +84,12 @@ data_train_norm.chunk({"valid_time": 32, "y": 786, "x": 1170}).to_zarr(
 data_valid_norm.chunk({"valid_time": 32, "y": 786, "x": 1170}).to_zarr(
     "/scratch/sadamov/aldernet/data_valid.zarr"
 )
+
+# Packed channels-last copies: one contiguous (valid_time, y, x, channel) read per batch
+# Chunked along y/x too, so that patches (Batcher(patch_size=...)) read sub-chunks
+pack_channels(data_train_norm, time_chunk=32, spatial_chunk=(128, 128)).to_zarr(
+    "/scratch/sadamov/aldernet/data_train_packed.zarr"
+)
+pack_channels(data_valid_norm, time_chunk=32, spatial_chunk=(128, 128)).to_zarr(
+    "/scratch/sadamov/aldernet/data_valid_packed.zarr"
+)
@@ -2,6 +2,15 @@
 
 # Standard library
 import math
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 # Third-party
 import numpy as np
@@ -31,52 +40,544 @@ select_params = [
 ]
 
 
-class Batcher(tf.keras.utils.Sequence):
-    """Generates data for Keras."""
+def pack_channels(data, time_chunk=32, spatial_chunk=None):
+    """Stack the selected variables into one ``(valid_time, y, x, channel)`` array.
+
+    The inputs (CORY and the weather fields) come first and the target ALNU last,
+    so a batch is a single contiguous read that ``Batcher`` splits into views. The
+    store is chunked along ``valid_time`` only, unless ``spatial_chunk=(y, x)`` is
+    given to make patch reads (``Batcher(patch_size=...)``) fetch sub-chunks.
+    """
+    weather_params = [param for param in select_params if param not in ("ALNU", "CORY")]
+    packed = (
+        data[["CORY"] + weather_params + ["ALNU"]]
+        .to_array("channel")
+        .transpose("valid_time", "y", "x", "channel")
+    )
+    packed.encoding.clear()
+    chunk_y, chunk_x = spatial_chunk if spatial_chunk is not None else (-1, -1)
+    return packed.chunk(
+        {"valid_time": time_chunk, "y": chunk_y, "x": chunk_x, "channel": -1}
+    ).to_dataset(name="packed")
+
+
+def importance_probs(pollen_mean, exponent, floor=1.0):
+    """Return sampling probabilities from per-timestep mean pollen concentrations.
+
+    Timesteps are drawn with probability proportional to
+    ``(pollen_mean + floor) ** exponent``: 0 samples uniformly, larger exponents
+    favour high-pollen timesteps more strongly while still drawing low ones.
+    """
+    weights = (np.asarray(pollen_mean, dtype="float64") + floor) ** exponent
+    return weights / weights.sum()
+
+
+def split_batch(batch, add_weather):
+    """Return ``(hazel, weather, alder, weight)`` of a ``Batcher`` batch.
+
+    ``weather`` and ``weight`` are None when the batch does not contain them.
+    """
+    n_arrays = 3 if add_weather else 2
+    weight = batch[n_arrays] if len(batch) > n_arrays else None
+    if add_weather:
+        return batch[0], batch[1], batch[2], weight
+    return batch[0], None, batch[1], weight
+
 
-    def __init__(self, data, batch_size, add_weather, shuffle=True):
+class ChunkCache:
+    """LRU cache of decoded chunks, held in RAM and spilled to a local directory.
+
+    Beyond ``max_bytes`` chunks are spilled as memory-mapped ``.npy`` files into a
+    temporary directory of their own within ``spill_dir``, removed on ``close``.
+    """
+
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=None):
         """Initialize."""
-        self.x = data[["CORY"]].to_array("var").transpose("valid_time", ..., "var")
-        if add_weather:
-            self.weather = (
-                data[select_params]
-                .drop_vars(("ALNU", "CORY"))
-                .to_array("var")
-                .transpose("valid_time", ..., "var")
+        self.max_bytes = max_bytes
+        self.spill_dir = None
+        self.max_spill_bytes = max_spill_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        # Futures of the chunks being loaded, for the threads waiting on them
+        self.loading = {}
+        if spill_dir is not None:
+            Path(spill_dir).mkdir(parents=True, exist_ok=True)
+            self.spill_dir = Path(tempfile.mkdtemp(prefix="chunks-", dir=spill_dir))
+            self._remove = weakref.finalize(
+                self, shutil.rmtree, self.spill_dir, ignore_errors=True
             )
-        self.y = data[["ALNU"]].to_array("var").transpose("valid_time", ..., "var")
+
+    def close(self):
+        """Drop the spilled chunks and remove their directory."""
+        with self.lock:
+            self.disk.clear()
+            self.disk_bytes = 0
+            if self.spill_dir is not None:
+                self._remove()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.memory or key in self.disk
+
+    def _lookup(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if key in self.disk:
+            self.disk.move_to_end(key)
+            return [np.load(path, mmap_mode="r") for path in self.disk[key][0]]
+        return None
+
+    def get(self, key):
+        """Return the arrays cached under ``key``, or None."""
+        with self.lock:
+            return self._lookup(key)
+
+    def get_or_load(self, key, load):
+        """Return the arrays cached under ``key``, caching ``load()`` if missing.
+
+        ``load`` runs outside the lock, so different chunks load in parallel, and
+        only in the first thread asking for ``key``; the others wait for its result.
+        """
+        with self.lock:
+            arrays = self._lookup(key)
+            if arrays is not None:
+                return arrays
+            future = self.loading.get(key)
+            first = future is None
+            if first:
+                future = self.loading[key] = Future()
+        if not first:
+            return future.result()
+        try:
+            arrays = load()
+        except BaseException as error:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(error)
+            raise
+        self.put(key, arrays)
+        with self.lock:
+            del self.loading[key]
+        future.set_result(arrays)
+        return arrays
+
+    def put(self, key, arrays):
+        """Cache ``arrays`` under ``key``, evicting least recently used chunks."""
+        with self.lock:
+            if key in self.memory or key in self.disk:
+                return
+            self.memory[key] = arrays
+            self.memory_bytes += sum(array.nbytes for array in arrays)
+            while self.memory_bytes > self.max_bytes and self.memory:
+                old_key, old_arrays = self.memory.popitem(last=False)
+                self.memory_bytes -= sum(array.nbytes for array in old_arrays)
+                if self.spill_dir is not None:
+                    self._spill(old_key, old_arrays)
+
+    def _spill(self, key, arrays):
+        paths = []
+        for i, array in enumerate(arrays):
+            paths.append(self.spill_dir / f"{key}_{i}.npy")
+            np.save(paths[-1], array)
+        nbytes = sum(array.nbytes for array in arrays)
+        self.disk[key] = (paths, nbytes)
+        self.disk_bytes += nbytes
+        while (
+            self.max_spill_bytes is not None and self.disk_bytes > self.max_spill_bytes
+        ):
+            old_paths, old_nbytes = self.disk.popitem(last=False)[1]
+            for path in old_paths:
+                path.unlink()
+            self.disk_bytes -= old_nbytes
+
+
+class Batcher(tf.keras.utils.Sequence):
+    """Generates data for Keras.
+
+    Samples are served in ``self.order``; with ``buffer_chunks`` shuffling stays
+    within windows of that many Zarr chunks. Batches can hold random ``patch_size``
+    crops, ``context``-step input windows shaped (batch, k, y, x, var), importance
+    samples redrawn every epoch, or one worker's ``shard``. With ``remainder`` set to
+    ``"drop"`` or ``"pad"`` every batch has the same static shape; padding and
+    importance sampling end every batch with a ``sample_weight`` array.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        data,
+        batch_size,
+        add_weather,
+        shuffle=True,
+        buffer_chunks=None,
+        cache=None,
+        patch_size=None,
+        patch_bias=0.0,
+        context=1,
+        remainder="partial",
+        importance_exponent=None,
+        shard=None,
+    ):
+        """Initialize."""
+        if "packed" in data.data_vars:
+            # Output of ``pack_channels``: CORY, weather..., ALNU along one axis
+            self.packed = data["packed"].rename(channel="var")
+            self._split_packed(add_weather)
+        else:
+            self.packed = None
+            self.x = data[["CORY"]].to_array("var").transpose("valid_time", ..., "var")
+            if add_weather:
+                self.weather = (
+                    data[select_params]
+                    .drop_vars(("ALNU", "CORY"))
+                    .to_array("var")
+                    .transpose("valid_time", ..., "var")
+                )
+            self.y = data[["ALNU"]].to_array("var").transpose("valid_time", ..., "var")
         self.batch_size = batch_size
         self.add_weather = add_weather
         self.shuffle = shuffle
+        self.buffer_chunks = buffer_chunks
+        source = self.packed if self.packed is not None else self.y
+        self.time_chunk = source.chunks[0][0] if source.chunks else source.shape[0]
+        if cache is None and buffer_chunks:
+            cache = ChunkCache(max_bytes=2 * buffer_chunks * self._chunk_nbytes())
+        self.cache = cache
+        self.patch_size = patch_size
+        self.patch_probs = None
+        if patch_size is not None and patch_bias > 0:
+            self.patch_probs = self._patch_probs(patch_bias)
+        if context > 1 and patch_size is not None:
+            raise ValueError("context windows cannot be combined with patch_size")
+        self.context = context
+        if remainder not in ("partial", "drop", "pad"):
+            raise ValueError(f"unknown remainder mode {remainder!r}")
+        self.remainder = remainder
+        self.samples = self._eligible_samples()
+        if shard is not None:
+            index, count = shard
+            # Equal shares, so that all workers run the same number of steps
+            usable = len(self.samples) - len(self.samples) % count
+            self.samples = np.array_split(self.samples[:usable], count)[index]
+        self.order = self.samples
+        self.sample_probs = None
+        if importance_exponent is not None:
+            self.sample_probs = importance_probs(
+                self.x.pollen_mean.values[self.samples], importance_exponent
+            )
+            self.index_weights = np.zeros(self.x.shape[0], dtype="float32")
+            self.index_weights[self.samples] = 1 / (
+                len(self.samples) * self.sample_probs
+            )
         self.on_epoch_end()
 
+    def _split_packed(self, add_weather):
+        """Expose the packed channels as the usual ``x``/``weather``/``y`` arrays."""
+        if not add_weather:
+            # Select CORY and ALNU lazily, so that reads skip the weather channels
+            self.packed = self.packed.isel(var=[0, -1])
+        self.x = self.packed.isel(var=slice(0, 1))
+        if add_weather:
+            self.weather = self.packed.isel(var=slice(1, -1))
+        self.y = self.packed.isel(var=slice(-1, None))
+
+    def _sources(self):
+        if self.packed is not None:
+            return [self.packed]
+        elif self.add_weather:
+            return [self.x, self.weather, self.y]
+        else:
+            return [self.x, self.y]
+
+    def _eligible_samples(self):
+        """Return the indices of the samples with a full, gapless context window."""
+        if self.context == 1:
+            return np.arange(self.x.shape[0])
+        times = self.x.valid_time.values
+        step = np.diff(times).min()
+        lag = self.context - 1
+        gapless = times[lag:] - times[:-lag] == lag * step
+        return np.flatnonzero(gapless) + lag
+
+    def _split(self, arrays):
+        # With context windows the target is the last timestep of its window
+        last = (slice(None), -1) if self.context > 1 else (slice(None),)
+        if self.packed is None:
+            return tuple(arrays[:-1]) + (arrays[-1][last],)
+        batch = arrays[0]
+        if self.add_weather:
+            return (
+                batch[..., :1],
+                batch[..., 1:-1],
+                batch[last + (..., slice(-1, None))],
+            )
+        else:
+            return batch[..., :1], batch[last + (..., slice(-1, None))]
+
+    def _chunk_nbytes(self):
+        return sum(
+            self.time_chunk * math.prod(source.shape[1:]) * source.dtype.itemsize
+            for source in self._sources()
+        )
+
+    def _decoded_chunk(self, chunk):
+        """Return the decoded arrays of one chunk through ``self.cache``."""
+        start = chunk * self.time_chunk
+        return self.cache.get_or_load(
+            chunk,
+            lambda: [
+                source[start : start + self.time_chunk].values
+                for source in self._sources()
+            ],
+        )
+
+    def _patch_probs(self, patch_bias):
+        """Return the probability of each crop offset, from the mean target field."""
+        height, width = self.patch_size
+        climatology = self.y[..., 0].mean("valid_time").values.astype("float64")
+        # Crop means for all offsets at once, through a summed-area table
+        table = np.pad(climatology.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+        sums = (
+            table[height:, width:]
+            - table[:-height, width:]
+            - table[height:, :-width]
+            + table[:-height, :-width]
+        )
+        logits = patch_bias * sums / (height * width)
+        probs = np.exp(logits - logits.max())
+        return probs / probs.sum()
+
+    def _patch_offsets(self, count):
+        height, width = self.patch_size
+        if self.patch_probs is not None:
+            flat = np.random.choice(
+                self.patch_probs.size, count, p=self.patch_probs.ravel()
+            )
+            return np.unravel_index(flat, self.patch_probs.shape)
+        tops = np.random.randint(0, self.x.shape[1] - height + 1, count)
+        lefts = np.random.randint(0, self.x.shape[2] - width + 1, count)
+        return tops, lefts
+
+    def _read_patches(self, indices):
+        """Read one random crop of ``self.patch_size`` per sample at ``indices``.
+
+        The samples are grouped by time chunk, and every chunk along ``y``/``x``
+        touched by the crops of a group is read once for the whole group.
+        """
+        height, width = self.patch_size
+        arrays = [
+            np.empty(
+                (len(indices), height, width) + source.shape[3:], dtype=source.dtype
+            )
+            for source in self._sources()
+        ]
+        tops, lefts = self._patch_offsets(len(indices))
+        chunk_ids = indices // self.time_chunk
+        for chunk in np.unique(chunk_ids):
+            rows = np.flatnonzero(chunk_ids == chunk)
+            if self.cache is not None:
+                blocks = self._decoded_chunk(chunk)
+                for row in rows:
+                    crop = (
+                        indices[row] - chunk * self.time_chunk,
+                        slice(tops[row], tops[row] + height),
+                        slice(lefts[row], lefts[row] + width),
+                    )
+                    for array, block in zip(arrays, blocks):
+                        array[row] = block[crop]
+                continue
+            for array, source in zip(arrays, self._sources()):
+                self._read_tiles(source, array, rows, indices, tops, lefts)
+        return arrays
+
+    def _read_tiles(  # pylint: disable=R0913
+        self, source, array, rows, indices, tops, lefts
+    ):
+        """Fill ``array[rows]`` with crops of ``source``, reading each tile once."""
+        height, width = self.patch_size
+        # Tile edges along y and x: the store's chunks, or the whole field
+        edges = [
+            np.cumsum((0,) + source.chunks[axis])
+            if source.chunks
+            else np.array([0, source.shape[axis]])
+            for axis in (1, 2)
+        ]
+        tiles = {}
+        for row in rows:
+            first_y, last_y = np.searchsorted(
+                edges[0], [tops[row], tops[row] + height - 1], side="right"
+            )
+            first_x, last_x = np.searchsorted(
+                edges[1], [lefts[row], lefts[row] + width - 1], side="right"
+            )
+            for tile_y in range(first_y - 1, last_y):
+                for tile_x in range(first_x - 1, last_x):
+                    tiles.setdefault((tile_y, tile_x), []).append(row)
+        times = np.unique(indices[rows])
+        for (tile_y, tile_x), tile_rows in tiles.items():
+            y_0, y_1 = edges[0][tile_y], edges[0][tile_y + 1]
+            x_0, x_1 = edges[1][tile_x], edges[1][tile_x + 1]
+            tile = source.isel(
+                valid_time=times, y=slice(y_0, y_1), x=slice(x_0, x_1)
+            ).values
+            for row in tile_rows:
+                top, left = tops[row], lefts[row]
+                ys = slice(max(top, y_0), min(top + height, y_1))
+                xs = slice(max(left, x_0), min(left + width, x_1))
+                array[
+                    row,
+                    ys.start - top : ys.stop - top,
+                    xs.start - left : xs.stop - left,
+                ] = tile[
+                    np.searchsorted(times, indices[row]),
+                    ys.start - y_0 : ys.stop - y_0,
+                    xs.start - x_0 : xs.stop - x_0,
+                ]
+
+    def _read_span(self, start, stop):
+        """Read the timesteps ``start:stop`` of every source in one contiguous read."""
+        if self.cache is None:
+            return [source[start:stop].values for source in self._sources()]
+        blocks = [
+            self._decoded_chunk(chunk)
+            for chunk in range(
+                start // self.time_chunk, (stop - 1) // self.time_chunk + 1
+            )
+        ]
+        offset = start - (start // self.time_chunk) * self.time_chunk
+        if len(blocks) == 1:
+            return [block[offset : offset + stop - start] for block in blocks[0]]
+        return [
+            np.concatenate(parts)[offset : offset + stop - start]
+            for parts in zip(*blocks)
+        ]
+
+    def _read_windows(self, indices):
+        """Read the ``self.context`` timesteps up to each of ``indices``."""
+        lag = self.context - 1
+        if np.all(np.diff(indices) == 1):
+            spans = self._read_span(indices[0] - lag, indices[-1] + 1)
+            return [
+                np.moveaxis(
+                    np.lib.stride_tricks.sliding_window_view(span, lag + 1, axis=0),
+                    -1,
+                    1,
+                )
+                for span in spans
+            ]
+        arrays = [
+            np.empty((len(indices), lag + 1) + source.shape[1:], dtype=source.dtype)
+            for source in self._sources()
+        ]
+        for row, index in enumerate(indices):
+            for array, span in zip(arrays, self._read_span(index - lag, index + 1)):
+                array[row] = span
+        return arrays
+
+    def _read(self, indices):
+        """Read the samples at ``indices`` along ``valid_time``."""
+        if self.context > 1:
+            return self._read_windows(indices)
+        if self.patch_size is not None:
+            return self._read_patches(indices)
+        if self.cache is not None:
+            chunk_ids = indices // self.time_chunk
+            arrays = [
+                np.empty((len(indices),) + source.shape[1:], dtype=source.dtype)
+                for source in self._sources()
+            ]
+            for chunk in np.unique(chunk_ids):
+                rows = chunk_ids == chunk
+                offsets = indices[rows] - chunk * self.time_chunk
+                for array, block in zip(arrays, self._decoded_chunk(chunk)):
+                    array[rows] = block[offsets]
+            return arrays
+        if np.all(np.diff(indices) == 1):
+            return [
+                source[indices[0] : indices[-1] + 1].values
+                for source in self._sources()
+            ]
+        return [source.isel(valid_time=indices).values for source in self._sources()]
+
     def __len__(self):
         """Denotes the number of batches per epoch."""
-        return math.ceil(self.x.shape[0] / self.batch_size)
+        if self.remainder == "drop":
+            return len(self.order) // self.batch_size
+        return math.ceil(len(self.order) / self.batch_size)
 
     def __getitem__(self, idx):
         """Generate one batch of data."""
-        batch_x = self.x[idx * self.batch_size : (idx + 1) * self.batch_size]
-        batch_y = self.y[idx * self.batch_size : (idx + 1) * self.batch_size]
-        if self.add_weather:
-            batch_weather = self.weather[
-                idx * self.batch_size : (idx + 1) * self.batch_size
-            ]
-            return batch_x.values, batch_weather.values, batch_y.values
-        else:
-            return batch_x.values, batch_y.values
-
-    def on_epoch_end(self):
-        """Update indexes after each epoch."""
-        if self.shuffle is True:
-            shuffle_x = self.x.values
-            np.random.shuffle(shuffle_x)
-            self.x.values = shuffle_x
-            shuffle_y = self.y.values
-            np.random.shuffle(shuffle_y)
-            self.y.values = shuffle_y
-            if self.add_weather:
-                shuffle_weather = self.weather.values
-                np.random.shuffle(shuffle_weather)
-                self.weather.values = shuffle_weather
+        indices = self.order[idx * self.batch_size : (idx + 1) * self.batch_size]
+        if self.remainder != "pad" and self.sample_probs is None:
+            return self._split(self._read(indices))
+        weights = np.ones(self.batch_size, dtype="float32")
+        if self.remainder == "pad":
+            weights[len(indices) :] = 0
+            # Pad with copies of real samples, keeping BatchNorm statistics plausible
+            indices = np.resize(indices, self.batch_size)
+        if self.sample_probs is not None:
+            weights[: len(indices)] *= self.index_weights[indices]
+            weights = weights[: len(indices)]
+        return self._split(self._read(indices)) + (weights,)
+
+    def take(self, indices):
+        """Read the samples at ``indices`` along ``valid_time`` as one batch."""
+        return self._split(self._read(np.asarray(indices)))
+
+    def prefetch(self, workers=4, depth=None, batches=None, start=0):
+        """Iterate over the batches of one epoch, reading ahead in a thread pool.
+
+        Up to ``depth`` batches (default ``2 * workers``) are prepared while the
+        caller works on the current one, and batches are yielded in order. Zarr
+        decompression releases the GIL, so threads hide most of the read latency.
+        The pool is shut down when the epoch is exhausted or the loop is left early.
+        With ``workers=0`` the batches are read synchronously. ``start`` skips the
+        first batches, e.g. to resume an epoch.
+        """
+        batches = len(self) if batches is None else min(batches, len(self))
+        if workers == 0:
+            for idx in range(start, batches):
+                yield self[idx]
+            return
+        depth = 2 * workers if depth is None else depth
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+        try:
+            for idx in range(start, batches):
+                pending.append(executor.submit(self.__getitem__, idx))
+                if len(pending) > depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def on_epoch_end(self, seed=None):
+        """Update indexes after each epoch.
+
+        With ``seed`` the new order is reproducible, e.g. to resume an epoch.
+        """
+        random = np.random if seed is None else np.random.default_rng(seed)
+        samples = self.samples
+        if self.sample_probs is not None:
+            samples = np.sort(
+                random.choice(self.samples, len(self.samples), p=self.sample_probs)
+            )
+        if self.shuffle is True and self.buffer_chunks:
+            n_chunks = math.ceil(self.x.shape[0] / self.time_chunk)
+            chunk_order = random.permutation(n_chunks)
+            sample_chunks = samples // self.time_chunk
+            windows = []
+            for i in range(0, n_chunks, self.buffer_chunks):
+                window = np.isin(sample_chunks, chunk_order[i : i + self.buffer_chunks])
+                windows.append(random.permutation(samples[window]))
+            self.order = np.concatenate(windows)
             print("Data Reshuffled!", flush=True)
+        elif self.shuffle is True:
+            self.order = random.permutation(samples)
+            print("Data Reshuffled!", flush=True)
+        else:
+            self.order = samples
@@ -25,6 +25,8 @@ from ray.air.callbacks.mlflow import MLflowLoggerCallback
 from tensorflow import random  # type: ignore
 
 # First-party
+from aldernet.cost_utils import estimate_cost
+from aldernet.cost_utils import peak_memory
 from aldernet.data.data_utils import Batcher
 from aldernet.training_utils import compile_generator
 from aldernet.training_utils import define_filters
@@ -36,16 +38,52 @@ from aldernet.training_utils import train_model_simple
 tune_with_ray = True
 zoom = ""
 noise_dim = 0
+noise_mode = "dense"  # "channel" or "spatial" to condition on noise without the Dense
 epochs = 3
 shuffle = False
+buffer_chunks = None  # shuffle within windows of this many Zarr chunks
+prefetch_workers = 4  # threads reading batches ahead of the training step
+valid_cache_bytes = None  # e.g. 16 * 2**30 to keep the decoded validation split
+valid_cache_dir = None  # node-local directory for validation chunks beyond that
+patch_size = None  # e.g. (128, 128) to train on random crops of the full domain
+patch_bias = 0.0  # > 0 favours crops in high-pollen regions
+context = 1  # number of timesteps up to the valid time fed to the generator
+importance_exponent = None  # draw timesteps by pollen_mean instead of uniformly
+jit_compile = False  # compile the training step with XLA
+eval_every_steps = None  # validate and report every N training steps
+eval_every_epochs = 1  # validate and report every N epochs
+valid_batches = None  # evaluate only the first N validation batches
+viz_every_steps = None  # write a PNG every N steps (None: with each report) ...
+viz_per_epoch = None  # ... or this many times per epoch instead
+viz_pretty = True  # matplotlib figures; False for fast colormapped triptychs
+viz_mode = "steps"  # "sheet": one contact sheet of fixed samples per epoch
+viz_samples = 8  # number of validation samples on the contact sheet
+viz_gif = False  # also animate the contact sheets across epochs
+checkpoint_every = 1  # checkpoint with every N-th report, for Tune to resume trials
 add_weather = False
+packed = False  # read the (valid_time, y, x, channel) stores from pack_channels
 conv = False
+precision = "float32"  # "mixed": bfloat16 on CPU, float16 with loss scaling on GPU
+distribute = None  # "mirrored" over the trial's GPUs, "multi_worker" over TF_CONFIG
+gpus_per_trial = 1
+accumulate_steps = 1  # read each batch_size batch in this many micro-batches
+recompute = ()  # e.g. ("down", "up"): blocks recomputed in the backward pass
+spectral_norm = ()  # e.g. ("cbr",): spectrally normalised blocks, none recomputed
+separable = False  # depthwise-separable convolutions, for a cheaper generator
+upsample = "transpose"  # "resize": bilinear resize and conv in the up blocks
+width_multiplier = 1  # scales the filters of all blocks
+cpu_devices = None  # split the CPU into N logical devices, e.g. to try "mirrored"
+batch_sizes = [32]  # search space of the batch size
+memory_budget = None  # bytes per device: drop batch sizes estimated not to fit
+benchmark_batch = None  # e.g. 2: time steps of this many samples (holds device memory)
 # -------------------------------#
 
 
-tf_setup()
+policy = tf_setup(precision, cpu_devices=cpu_devices)
 random.set_seed(1)
 
+store_suffix = "_packed.zarr" if packed else ".zarr"
+
 run_path = str(here()) + "/output/" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 if tune_with_ray:
     Path(run_path + "/viz/valid").mkdir(parents=True, exist_ok=True)
@@ -53,38 +91,89 @@ if tune_with_ray:
 hostname = socket.gethostname()
 if "tsa" in hostname:
     data_train = xr.open_zarr(
-        "/scratch/sadamov/pyprojects_data/aldernet/" + zoom + "/data_train.zarr"
+        "/scratch/sadamov/pyprojects_data/aldernet/"
+        + zoom
+        + "/data_train"
+        + store_suffix
     )
     data_valid = xr.open_zarr(
-        "/scratch/sadamov/pyprojects_data/aldernet/" + zoom + "/data_valid.zarr"
+        "/scratch/sadamov/pyprojects_data/aldernet/"
+        + zoom
+        + "/data_valid"
+        + store_suffix
     )
 elif "nid" in hostname:
     data_train = xr.open_zarr(
         "/scratch/e1000/meteoswiss/scratch/sadamov/aldernet/"
         + zoom
-        + "/data_train.zarr"
+        + "/data_train"
+        + store_suffix
     )
     data_valid = xr.open_zarr(
         "/scratch/e1000/meteoswiss/scratch/sadamov/aldernet/"
         + zoom
-        + "/data_valid.zarr"
+        + "/data_valid"
+        + store_suffix
     )
 
 if tune_with_ray:
-    height = data_train.CORY.shape[1]
-    width = data_train.CORY.shape[2]
-    if add_weather:
+    if patch_size is not None:
+        # The U-Net is fully convolutional: weights trained on crops can be loaded
+        # into a generator compiled for the full domain for inference
+        height, width = patch_size
+    else:
+        height = data_train.sizes["y"]
+        width = data_train.sizes["x"]
+    if add_weather and packed:
+        weather_features = data_train.sizes["channel"] - 2
+    elif add_weather:
         weather_features = len(data_train.drop_vars(("ALNU", "CORY")).data_vars)
     else:
         weather_features = 0
     filters = define_filters(zoom)
-    generator = compile_generator(height, width, weather_features, noise_dim, filters)
+    generator = compile_generator(
+        height,
+        width,
+        weather_features,
+        noise_dim,
+        filters,
+        context=context,
+        recompute=recompute,
+        noise_mode=noise_mode,
+        spectral_norm=spectral_norm,
+        separable=separable,
+        upsample=upsample,
+        width_multiplier=width_multiplier,
+    )
 
     with open(run_path + "/generator_summary.txt", "w", encoding="UTF-8") as handle:
         with redirect_stdout(handle):
             generator.summary()
     plot_model(generator, to_file=run_path + "/generator.png", show_shapes=True, dpi=96)
 
+    # Estimate the cost of each trial before Ray schedules any
+    replicas = gpus_per_trial if distribute is not None else 1
+    cost = estimate_cost(
+        generator,
+        batch_size=max(batch_sizes) // (replicas * accumulate_steps),
+        benchmark_batch=benchmark_batch,
+        jit_compile=jit_compile,
+    )
+    with open(run_path + "/generator_cost.txt", "w", encoding="UTF-8") as handle:
+        for key, value in cost.items():
+            handle.write(f"{key}: {value:.4g}\n")
+    if memory_budget is not None:
+        batch_sizes = [
+            batch_size
+            for batch_size in batch_sizes
+            if peak_memory(cost, batch_size // (replicas * accumulate_steps))
+            <= memory_budget
+        ]
+        if not batch_sizes:
+            raise ValueError(
+                f"No batch size fits into the memory budget of {memory_budget} bytes"
+            )
+
     # Train
 
     # Use hyperparameter search functionality by ray tune and log experiment
@@ -106,25 +195,49 @@ if tune_with_ray:
             noise_dim=noise_dim,
             add_weather=add_weather,
             shuffle=shuffle,
+            buffer_chunks=buffer_chunks,
+            prefetch_workers=prefetch_workers,
+            valid_cache_bytes=valid_cache_bytes,
+            valid_cache_dir=valid_cache_dir,
+            patch_size=patch_size,
+            patch_bias=patch_bias,
+            context=context,
+            importance_exponent=importance_exponent,
+            jit_compile=jit_compile,
+            eval_every_steps=eval_every_steps,
+            eval_every_epochs=eval_every_epochs,
+            valid_batches=valid_batches,
+            viz_every_steps=viz_every_steps,
+            viz_per_epoch=viz_per_epoch,
+            viz_pretty=viz_pretty,
+            viz_mode=viz_mode,
+            viz_samples=viz_samples,
+            viz_gif=viz_gif,
+            checkpoint_every=checkpoint_every,
+            distribute=distribute,
+            accumulate_steps=accumulate_steps,
         ),
         # metric="Loss",
         num_samples=1,
         scheduler=tune.schedulers.ASHAScheduler(
-            time_attr="training_iteration",
+            # Reports come every eval_every_steps, count the epochs trained instead
+            time_attr="epoch",
             metric="Loss",
             mode="min",
             max_t=epochs,
             grace_period=3,
             reduction_factor=3,
         ),
-        resources_per_trial={"gpu": 1},  # Choose appropriate Device
+        resources_per_trial={"gpu": gpus_per_trial},  # Choose appropriate Device
         # stop={"training_iteration": 2},
         config={
             # define search space here
             "learning_rate": tune.choice([0.0001]),
             "beta_1": tune.choice([0.85]),
             "beta_2": tune.choice([0.97]),
-            "batch_size": tune.choice([10]),
+            "batch_size": tune.choice(batch_sizes),
+            # Recorded with the run; the generator above was built under it
+            "precision": policy,
             "mlflow": {
                 "experiment_name": "Aldernet",
                 "tracking_uri": mlflow.get_tracking_uri(),
@@ -147,10 +260,20 @@ if tune_with_ray:
     subprocess.run(rsync_cmd, shell=True, check=True)
 else:
     batcher_train = Batcher(
-        data_train, batch_size=32, add_weather=add_weather, shuffle=shuffle
+        data_train,
+        batch_size=32,
+        add_weather=add_weather,
+        shuffle=shuffle,
+        buffer_chunks=buffer_chunks,
+        remainder="pad",
     )
     batcher_valid = Batcher(
-        data_valid, batch_size=32, add_weather=add_weather, shuffle=shuffle
+        data_valid,
+        batch_size=32,
+        add_weather=add_weather,
+        shuffle=shuffle,
+        buffer_chunks=buffer_chunks,
+        remainder="pad",
     )
     train_model_simple(
         batcher_train, batcher_valid, epochs=epochs, add_weather=add_weather, conv=conv
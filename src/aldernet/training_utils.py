@@ -10,25 +10,30 @@ To create realistic Images of Pollen Surface Concentration Maps.
 # pylint: disable=no-member
 
 # Standard library
+import contextlib
+import itertools
 import math
+import tempfile
 import time
-from pathlib import Path
+import zlib
 
 # Third-party
 import keras  # type: ignore
-import matplotlib.pyplot as plt  # type: ignore
 import mlflow  # type: ignore
 import numpy as np
 import tensorflow as tf  # type: ignore
 import xarray as xr
 from keras import layers
-from keras.constraints import Constraint  # type: ignore
 from pyprojroot import here  # type: ignore
 from ray import air
 from ray import tune
 
 # First-party
 from aldernet.data.data_utils import Batcher
+from aldernet.data.data_utils import ChunkCache
+from aldernet.data.data_utils import split_batch
+from aldernet.viz_utils import VizWriter
+from aldernet.viz_utils import write_png
 
 
 def define_filters(zoom):
@@ -43,7 +48,20 @@ def define_filters(zoom):
 ##########################
 
 
-def tf_setup():
+def precision_policy(precision="float32"):
+    """Resolve ``precision`` to the name of a Keras mixed precision policy.
+
+    ``"mixed"`` picks ``mixed_float16`` on GPUs and ``mixed_bfloat16`` on CPUs,
+    where oneDNN accelerates bfloat16; policy names are returned as they are.
+    """
+    if precision == "mixed":
+        if tf.config.list_physical_devices("GPU"):
+            return "mixed_float16"
+        return "mixed_bfloat16"
+    return precision
+
+
+def tf_setup(precision="float32", cpu_devices=None):
     gpus = tf.config.experimental.list_physical_devices("GPU")
     if gpus:
         try:
@@ -51,75 +69,202 @@ def tf_setup():
                 tf.config.experimental.set_memory_growth(gpu, True)
         except RuntimeError as e:
             print(e)
+    if cpu_devices:
+        # Split the CPU into logical devices, e.g. to try out "mirrored" training
+        cpus = tf.config.list_physical_devices("CPU")
+        try:
+            tf.config.set_logical_device_configuration(
+                cpus[0], [tf.config.LogicalDeviceConfiguration()] * cpu_devices
+            )
+        except RuntimeError as e:
+            print(e)
+    # Layers built from here on compute in this policy's dtype
+    policy = precision_policy(precision)
+    tf.keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+
+def batch_norm_layers(model):
+    """Yield the ``BatchNormalization`` layers of ``model``, also in nested blocks."""
+    for layer in model.layers:
+        if isinstance(layer, layers.BatchNormalization):
+            yield layer
+        elif hasattr(layer, "layers"):
+            yield from batch_norm_layers(layer)
+
+
+def distribution_strategy(distribute=None):
+    """Return the ``tf.distribute`` strategy named ``distribute``.
+
+    ``"mirrored"`` replicates the model over the local GPUs, or over the logical
+    CPUs of ``tf_setup`` without GPUs. ``"multi_worker"`` replicates it over the
+    nodes described by ``TF_CONFIG``, which the launcher has to provide for each
+    worker. ``None`` is the default single-device strategy.
+    """
+    if distribute is None:
+        return tf.distribute.get_strategy()
+    if distribute == "mirrored":
+        devices = tf.config.list_logical_devices(
+            "GPU"
+        ) or tf.config.list_logical_devices("CPU")
+        return tf.distribute.MirroredStrategy([device.name for device in devices])
+    if distribute == "multi_worker":
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError(f"unknown distribution strategy {distribute!r}")
+
+
+def worker_shard(strategy):
+    """Return ``(index, count)`` of this worker among the workers of ``strategy``."""
+    resolver = getattr(strategy, "cluster_resolver", None)
+    cluster = resolver.cluster_spec().as_dict() if resolver is not None else {}
+    if not cluster:
+        return 0, 1
+    tasks = [
+        (job, task)
+        for job in ("chief", "worker")
+        for task in range(len(cluster.get(job, [])))
+    ]
+    return tasks.index((resolver.task_type, resolver.task_id)), len(tasks)
+
+
+def distribute_batch(strategy, *arrays):
+    """Split a worker's batch evenly over the local replicas of ``strategy``.
+
+    ``None`` entries are passed on as they are, to be broadcast by ``strategy.run``.
+    """
+    replicas = len(strategy.extended.worker_devices)
+    present = [array for array in arrays if array is not None]
+    shards = iter(
+        strategy.experimental_distribute_values_from_function(
+            lambda context: tuple(
+                tf.convert_to_tensor(
+                    np.array_split(array, replicas)[
+                        context.replica_id_in_sync_group % replicas
+                    ]
+                )
+                for array in present
+            )
+        )
+    )
+    return tuple(None if array is None else next(shards) for array in arrays)
 
 
 ##########################
 
 
-class SpectralNormalization(Constraint):
-    def __init__(self, iterations=1):
-        """Define class objects."""
-        self.iterations = iterations
-        self.u = None
-
-    def __call__(self, w):
-        output_neurons = w.shape[-1]
-        w_ = tf.reshape(w, [-1, output_neurons])
-        if self.u is None:
-            self.u = tf.Variable(
-                initial_value=tf.random_normal_initializer()(
-                    shape=(output_neurons,), dtype="float32"
-                ),
-                trainable=False,
+@keras.utils.register_keras_serializable(package="aldernet")
+class SpectralNormalization(layers.Wrapper):
+    """Divide the kernel of ``layer`` by its largest singular value.
+
+    The singular value is estimated by ``iterations`` steps of power iteration per
+    training call, continuing from the vector ``u`` of the previous call. Outside
+    training ``u`` is left as is and the kernel normalised in the last training
+    call is used, at the cost of the bare layer.
+    """
+
+    def __init__(self, layer, iterations=1, **kwargs):
+        """Initialize."""
+        if isinstance(layer, (layers.SeparableConv2D, layers.DepthwiseConv2D)):
+            raise ValueError(
+                f"{type(layer).__name__} has no single kernel to normalise"
             )
+        super().__init__(layer, **kwargs)
+        self.iterations = iterations
+
+    def build(self, input_shape=None):
+        super().build(input_shape)
+        kernel = self.layer.kernel
+        # Replica-local like the moving statistics of BatchNormalization; the
+        # replicas agree, as the updates do not depend on the inputs
+        self.u = self.add_weight(
+            name="u",
+            shape=(kernel.shape[-1],),
+            initializer=tf.keras.initializers.RandomNormal(),
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.MEAN,
+        )
+        self.kernel_normalized = self.add_weight(
+            name="kernel_normalized",
+            shape=kernel.shape,
+            initializer=lambda shape, dtype: self.normalize()[0],
+            trainable=False,
+            synchronization=tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.MEAN,
+        )
 
-        u_ = self.u
-        v_ = None
+    def normalize(self):
+        """Return the normalised kernel and the next ``u``."""
+        # In float32 even under a mixed policy, whose variables are read in the
+        # compute dtype inside ``call``
+        kernel = tf.cast(self.layer.kernel, tf.float32)
+        matrix = tf.reshape(kernel, [-1, kernel.shape[-1]])
+        u = tf.cast(self.u, tf.float32)
         for _ in range(self.iterations):
-            v_ = tf.matvec(w_, u_)
-            v_ = tf.l2_normalize(v_)
+            v = tf.math.l2_normalize(tf.linalg.matvec(matrix, u))
+            u = tf.math.l2_normalize(tf.linalg.matvec(matrix, v, transpose_a=True))
+        u = tf.stop_gradient(u)
+        sigma = tf.tensordot(tf.stop_gradient(v), tf.linalg.matvec(matrix, u), axes=1)
+        return kernel / sigma, u
+
+    def call(self, inputs, training=None):
+        if training:
+            kernel, u = self.normalize()
+            self.u.assign(u)
+            self.kernel_normalized.assign(tf.stop_gradient(kernel))
+        else:
+            kernel = self.kernel_normalized
+        # The wrapped layer reads its kernel from the attribute
+        original = self.layer.kernel
+        self.layer.kernel = tf.cast(kernel, self.layer.compute_dtype)
+        try:
+            return self.layer(inputs)
+        finally:
+            self.layer.kernel = original
+
+    def get_config(self):
+        config = super().get_config()
+        config["iterations"] = self.iterations
+        return config
 
-            u_ = tf.matvec(w_, v_, transpose_a=True)
-            u_ = tf.l2_normalize(u_)
 
-        sigma = tf.tensordot(u_, tf.matvec(w_, v_, transpose_a=True), axes=1)
-        self.u.assign(u_)  # '=' produces an error in graph mode
-        return w / sigma
+def normalized(layer, spectral_norm=True):
+    """Wrap ``layer`` in ``SpectralNormalization`` if ``spectral_norm``."""
+    if not spectral_norm:
+        return layer
+    return SpectralNormalization(layer, name=f"{layer.name}-sn")
 
 
 ##########################
 
 
-def cbr(filters, name=None):
+def convolution(filters, kernel_size, strides=1, separable=False):
+    """Return a ``Conv2D`` of the blocks, or a ``SeparableConv2D`` if ``separable``."""
+    conv = layers.SeparableConv2D if separable else layers.Conv2D
+    return conv(
+        filters=filters,
+        kernel_size=kernel_size,
+        strides=strides,
+        padding="same",
+        use_bias=False,
+    )
+
+
+def cbr(filters, name=None, spectral_norm=False, separable=False):
 
     block = keras.Sequential(name=name)
-    block.add(
-        layers.Conv2D(
-            filters=filters,
-            kernel_size=3,
-            padding="same",
-            use_bias=False,
-            # kernel_constraint=SpectralNormalization(),
-        )
-    )
+    block.add(normalized(convolution(filters, 3, separable=separable), spectral_norm))
     block.add(layers.BatchNormalization())
     block.add(layers.LeakyReLU())
 
     return block
 
 
-def down(filters, name=None):
+def down(filters, name=None, spectral_norm=False, separable=False):
 
     block = keras.Sequential(name=name)
     block.add(
-        layers.Conv2D(
-            filters=filters,
-            kernel_size=4,
-            strides=2,
-            padding="same",
-            use_bias=False,
-            # kernel_constraint=SpectralNormalization(),
-        )
+        normalized(convolution(filters, 4, 2, separable=separable), spectral_norm)
     )
     block.add(layers.BatchNormalization())
     block.add(layers.LeakyReLU())
@@ -129,77 +274,242 @@ def down(filters, name=None):
     return block
 
 
-def up(filters, name=None):
+def up(  # pylint: disable=R0913
+    filters, name=None, spectral_norm=False, separable=False, upsample="transpose"
+):
 
     block = keras.Sequential(name=name)
-    block.add(
-        layers.Conv2DTranspose(
+    if upsample == "transpose":
+        conv = layers.Conv2DTranspose(
             filters=filters,
             kernel_size=4,
             strides=2,
             padding="same",
             use_bias=False,
-            # kernel_constraint=SpectralNormalization(),
         )
-    )
+    elif upsample == "resize":
+        # Bilinear, as XLA has no gradient of the nearest-neighbour resize on CPU
+        block.add(layers.UpSampling2D(2, interpolation="bilinear"))
+        conv = convolution(filters, 3, separable=separable)
+    else:
+        raise ValueError(f"unknown upsampling {upsample!r}")
+    block.add(normalized(conv, spectral_norm))
     block.add(layers.BatchNormalization())
     block.add(layers.LeakyReLU())
 
     return block
 
 
+@keras.utils.register_keras_serializable(package="aldernet")
+class Recompute(layers.Layer):
+    """Recompute a block in the backward pass instead of storing its activations.
+
+    Only the block's input is kept for the gradient (``tf.recompute_grad``). Use
+    ``recomputed`` to wrap a block, which accounts for the second BatchNorm update.
+    """
+
+    def __init__(self, block, **kwargs):
+        """Initialize."""
+        super().__init__(**kwargs)
+        self.block = block
+
+    @property
+    def layers(self):
+        return [self.block]
+
+    def call(self, inputs, training=None):
+        return tf.recompute_grad(lambda x: self.block(x, training=training))(inputs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["block"] = layers.serialize(self.block)
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        config["block"] = layers.deserialize(config["block"])
+        return cls(**config)
+
+
+def recomputed(block, recompute=True):
+    """Wrap ``block`` in ``Recompute`` if ``recompute``, else return it as is."""
+    if not recompute:
+        return block
+    # The recomputation updates the moving statistics a second time with the same
+    # batch; the square root of the momentum gives the same moving averages
+    for layer in batch_norm_layers(block):
+        layer.momentum = layer.momentum**0.5
+    return Recompute(block, name=f"{block.name}-recompute")
+
+
+@keras.utils.register_keras_serializable(package="aldernet")
+class ReflectPad2D(layers.Layer):
+    """Reflect-pad the y and x axes by ``((top, bottom), (left, right))``.
+
+    Another ``mode`` of ``tf.pad``, e.g. ``"CONSTANT"``, can be used instead.
+    """
+
+    def __init__(self, padding, mode="REFLECT", **kwargs):
+        """Initialize."""
+        super().__init__(**kwargs)
+        self.padding = tuple(tuple(pad) for pad in padding)
+        self.mode = mode
+
+    def call(self, inputs):
+        return tf.pad(inputs, [(0, 0), *self.padding, (0, 0)], mode=self.mode)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(padding=self.padding, mode=self.mode)
+        return config
+
+
+def stride_padding(height, width, stride):
+    """Return the ``ReflectPad2D`` padding to the next multiples of ``stride``.
+
+    The padding of ``height`` and ``width`` is split evenly between both sides.
+    """
+    padding = []
+    for size in (height, width):
+        extra = -size % stride
+        padding.append((extra // 2, extra - extra // 2))
+    return tuple(padding)
+
+
 ##########################
 
 
-def compile_generator(height, width, weather_features, noise_dim, filters):
-    image_input = keras.Input(shape=[height, width, 1], name="image_input")
+def fold_context(inputs, name):
+    """Fold a ``(context, y, x, var)`` input into ``context * var`` channels."""
+    context, height, width, channels = inputs.shape[1:]
+    folded = layers.Permute((2, 3, 1, 4), name=f"{name}-permute")(inputs)
+    return layers.Reshape((height, width, context * channels), name=f"{name}-fold")(
+        folded
+    )
+
+
+def latest_input(inputs, context):
+    """Return the last timestep of a batch of ``context``-step input windows."""
+    return inputs[:, -1] if context > 1 else inputs
+
+
+def compile_generator(  # pylint: disable=R0913
+    height,
+    width,
+    weather_features,
+    noise_dim,
+    filters,
+    context=1,
+    recompute=(),
+    noise_mode="dense",
+    spectral_norm=(),
+    separable=False,
+    upsample="transpose",
+    width_multiplier=1,
+):
+    """Build the U-Net generator for a domain of any size.
+
+    The inputs are padded to a multiple of the total stride and the output cropped
+    back. ``recompute`` and ``spectral_norm`` name disjoint kinds of blocks among
+    ``"cbr"``, ``"down"`` and ``"up"``. See ``noise_shape`` for the noise input of
+    each ``noise_mode``.
+    """
+    overlap = sorted(set(recompute) & set(spectral_norm))
+    if overlap:
+        raise ValueError(
+            f"{overlap} blocks cannot be both recomputed and spectrally normalised"
+        )
+    filters = [max(1, round(value * width_multiplier)) for value in filters]
+    # With context > 1 the inputs are stacks of the preceding timesteps
+    window = [context] if context > 1 else []
+    image_input = keras.Input(shape=window + [height, width, 1], name="image_input")
+    image = fold_context(image_input, "image") if context > 1 else image_input
     if weather_features > 0:
         weather_input = keras.Input(
-            shape=[height, width, weather_features], name="weather_input"
+            shape=window + [height, width, weather_features], name="weather_input"
         )
-        inputs = layers.Concatenate(name="inputs-concat")([image_input, weather_input])
+        weather = (
+            fold_context(weather_input, "weather") if context > 1 else weather_input
+        )
+        inputs = layers.Concatenate(name="inputs-concat")([image, weather])
     else:
-        inputs = image_input
-    block = cbr(filters[0], "pre-cbr-1")(inputs)
+        inputs = image
+    padding = stride_padding(height, width, 2 ** (len(filters) // 2 - 1))
+    if padding != ((0, 0), (0, 0)):
+        # Reflecting needs pads smaller than the field; tiny domains are zero-padded
+        fits = all(max(pad) < size for pad, size in zip(padding, (height, width)))
+        inputs = ReflectPad2D(
+            padding, mode="REFLECT" if fits else "CONSTANT", name="inputs-pad"
+        )(inputs)
+    block = recomputed(
+        cbr(filters[0], "pre-cbr-1", "cbr" in spectral_norm, separable),
+        "cbr" in recompute,
+    )(inputs)
 
     u_skip_layers = [block]
     for ll in range(1, len(filters) // 2):
-        block = down(filters[ll], f"down_{ll}-down")(block)
+        block = recomputed(
+            down(filters[ll], f"down_{ll}-down", "down" in spectral_norm, separable),
+            "down" in recompute,
+        )(block)
         # Collect U-Net skip connections
         u_skip_layers.append(block)
     height = block.shape[1]
     width = block.shape[2]
     if noise_dim > 0:
         noise_channels = 128
-        noise_input = keras.Input(shape=noise_dim, name="noise_input")
-        noise = layers.Dense(
-            height * width * noise_channels,
-            # kernel_constraint=SpectralNormalization()
-        )(noise_input)
-        noise = layers.Reshape((height, width, -1))(noise)
+        if noise_mode == "dense":
+            noise_input = keras.Input(shape=noise_dim, name="noise_input")
+            noise = layers.Dense(
+                height * width * noise_channels,
+            )(noise_input)
+            noise = layers.Reshape((height, width, -1))(noise)
+        elif noise_mode == "channel":
+            noise_input = keras.Input(shape=noise_dim, name="noise_input")
+            noise = layers.Dense(noise_channels, name="noise-dense")(noise_input)
+            noise = layers.Reshape((1, 1, noise_channels), name="noise-reshape")(noise)
+            noise = layers.UpSampling2D((height, width), name="noise-broadcast")(noise)
+        elif noise_mode == "spatial":
+            noise = noise_input = keras.Input(
+                shape=(height, width, noise_dim), name="noise_input"
+            )
+        else:
+            raise ValueError(f"unknown noise mode {noise_mode!r}")
         block = layers.Concatenate(name="add-noise")([block, noise])
     u_skip_layers.pop()
 
     for ll in range(len(filters) // 2, len(filters) - 1):
-        block = up(filters[ll], f"up_{(len(filters) - ll - 1)}-up")(block)
-        if block.shape[slice(1, 2)] != u_skip_layers[-1].shape[slice(1, 2)]:
-            block = layers.Cropping2D(cropping=((1, 0), (1, 0)), data_format=None)(
-                block
-            )
+        block = recomputed(
+            up(
+                filters[ll],
+                f"up_{(len(filters) - ll - 1)}-up",
+                "up" in spectral_norm,
+                separable,
+                upsample,
+            ),
+            "up" in recompute,
+        )(block)
         # Connect U-Net skip
         block = layers.Concatenate(name=f"up_{(len(filters) - ll - 1)}-concatenate")(
             [block, u_skip_layers.pop()]
         )
 
-    block = cbr(filters[-1], "post-cbr-1")(block)
+    block = recomputed(
+        cbr(filters[-1], "post-cbr-1", "cbr" in spectral_norm, separable),
+        "cbr" in recompute,
+    )(block)
+    if padding != ((0, 0), (0, 0)):
+        # Before the pointwise output layer, which stays in float32
+        block = layers.Cropping2D(padding, name="output-crop")(block)
 
     pollen = layers.Conv2D(
         filters=1,
         kernel_size=1,
         padding="same",
         activation="tanh",
-        # kernel_constraint=SpectralNormalization(),
         name="output",
+        # Keep the tanh output, and with it the loss, in float32 under mixed precision
+        dtype="float32",
     )(block)
     if weather_features > 0 and noise_dim > 0:
         return tf.keras.Model(
@@ -215,52 +525,101 @@ def compile_generator(height, width, weather_features, noise_dim, filters):
 
 ##########################
 
+bxe_loss = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+
+# * https://www.tensorflow.org/tutorials/customization/custom_training_walkthrough
+# * Autodifferentiation vs. calculate training steps yourself
+# * L1-Loss (Median) absolute value difference statt RMSE (Mean) also Loss - pixelwise
+# * Calculate difference between image_b and generated ones for regression
+# * Reduce output channels from 3 RGB to one pollen (+ height and width)
+# * Weather input was simply zero mean and unit variance
 
-def write_png(image, path, pretty):
 
-    if pretty:
+def noise_shape(generator):
+    """Return the shape of the noise of one sample for ``generator``, if any."""
+    shapes = dict(zip(generator.input_names, generator.inputs))
+    if "noise_input" not in shapes:
+        return None
+    return tuple(shapes["noise_input"].shape[1:])
 
-        minmin = min(image[0].min(), image[1].min(), image[2].min())
-        maxmax = max(image[0].max(), image[1].max(), image[2].max())
 
-        fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(10, 2.1), dpi=150)
-        ax1.imshow(
-            image[0][:, :, 0], cmap="viridis", vmin=minmin, vmax=maxmax, aspect="auto"
+def generator_inputs(noise_dim, add_weather, shape=None):
+    """Return a function assembling the generator inputs for one configuration.
+
+    The call pattern is chosen here once, instead of on every step. The noise is
+    a vector of ``noise_dim``, unless another ``shape`` per sample is given, such
+    as the ``noise_shape`` of a generator with ``noise_mode="spatial"``.
+    """
+    shape = [noise_dim] if shape is None else list(shape)
+
+    def assemble(input_train, weather_train):
+        inputs = [input_train]
+        if add_weather:
+            inputs.append(weather_train)
+        if noise_dim > 0:
+            inputs.insert(0, tf.random.normal([tf.shape(input_train)[0], *shape]))
+        return inputs
+
+    return assemble
+
+
+def scale_loss(optimizer, loss):
+    """Scale ``loss`` if ``optimizer`` uses loss scaling (float16 training)."""
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+
+def unscale_gradients(optimizer, gradients):
+    """Undo ``scale_loss`` on the ``gradients``."""
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(gradients)
+    return gradients
+
+
+def l1_loss(generated, target, sample_weight=None):
+    if sample_weight is None:
+        return tf.math.reduce_mean(tf.math.abs(generated - target))
+    # Per-sample L1, averaged with the Batcher's mask or importance weights
+    sample_loss = tf.math.reduce_mean(tf.math.abs(generated - target), axis=[1, 2, 3])
+    sample_weight = tf.cast(sample_weight, sample_loss.dtype)
+    return tf.math.reduce_sum(sample_weight * sample_loss) / tf.math.reduce_sum(
+        sample_weight
+    )
+
+
+class PollenMetrics:
+    """Running L1, L2 and bias of generated fields, accumulated on the device.
+
+    ``update`` only adds to ``tf.keras.metrics.Mean`` variables and can run inside
+    compiled steps; ``result`` is the only host synchronisation.
+    """
+
+    def __init__(self, suffix=""):
+        """Initialize."""
+        self.metrics = {
+            name: tf.keras.metrics.Mean(name=name + suffix)
+            for name in ("L1", "L2", "Bias")
+        }
+
+    def update(self, generated, target, sample_weight=None):
+        error = tf.cast(generated, tf.float32) - tf.cast(target, tf.float32)
+        self.metrics["L1"].update_state(
+            tf.math.reduce_mean(tf.math.abs(error), axis=[1, 2, 3]), sample_weight
         )
-        ax2.imshow(
-            image[1][:, :, 0], cmap="viridis", vmin=minmin, vmax=maxmax, aspect="auto"
+        self.metrics["L2"].update_state(
+            tf.math.reduce_mean(tf.math.square(error), axis=[1, 2, 3]), sample_weight
         )
-        im3 = ax3.imshow(
-            image[2][:, :, 0], cmap="viridis", vmin=minmin, vmax=maxmax, aspect="auto"
+        self.metrics["Bias"].update_state(
+            tf.math.reduce_mean(error, axis=[1, 2, 3]), sample_weight
         )
-        for ax in (ax1, ax2, ax3):
-            ax.axes.xaxis.set_visible(False)
-            ax.axes.yaxis.set_visible(False)
-        ax1.axes.set_title("Input")
-        ax2.axes.set_title("Target")
-        ax3.axes.set_title("Prediction")
-        fig.subplots_adjust(right=0.85, top=0.85)
-        cbar_ax = fig.add_axes([0.88, 0.15, 0.04, 0.7])
-        fig.colorbar(im3, cax=cbar_ax)
-        plt.savefig(path)
-        plt.close(fig)
-    else:
-        image = tf.concat(image, 1) * 10
-        image = tf.cast(image, tf.uint8)
-        png = tf.image.encode_png(image)
-        tf.io.write_file(path, png)
 
+    def result(self):
+        return {metric.name: float(metric.result()) for metric in self.metrics.values()}
 
-##########################
-
-bxe_loss = tf.keras.losses.BinaryCrossentropy(from_logits=True)
-
-# * https://www.tensorflow.org/tutorials/customization/custom_training_walkthrough
-# * Autodifferentiation vs. calculate training steps yourself
-# * L1-Loss (Median) absolute value difference statt RMSE (Mean) also Loss - pixelwise
-# * Calculate difference between image_b and generated ones for regression
-# * Reduce output channels from 3 RGB to one pollen (+ height and width)
-# * Weather input was simply zero mean and unit variance
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset_state()
 
 
 def gan_step(  # pylint: disable=R0913
@@ -271,410 +630,540 @@ def gan_step(  # pylint: disable=R0913
     weather_train,
     noise_dim,
     add_weather,
+    sample_weight=None,
+    return_generated=False,
 ):
 
-    if noise_dim > 0:
-        noise = tf.random.normal([input_train.shape[0], noise_dim])
     with tf.GradientTape() as tape_gen:
-        if add_weather and noise_dim > 0:
-            generated = generator([noise, input_train, weather_train])
-        elif add_weather and noise_dim <= 0:
-            generated = generator([input_train, weather_train])
-        elif not add_weather and noise_dim > 0:
-            generated = generator([noise, input_train])
-        else:
-            generated = generator([input_train])
-        loss = tf.math.reduce_mean(tf.math.abs(generated - target_train))
+        generated = generator(
+            generator_inputs(noise_dim, add_weather, noise_shape(generator))(
+                input_train, weather_train
+            ),
+            training=True,
+        )
+        loss = l1_loss(generated, target_train, sample_weight)
         # loss = tf.math.reduce_mean(tf.math.squared_difference(generated, alder))
-        gradients_gen = tape_gen.gradient(loss, generator.trainable_variables)
+        scaled_loss = scale_loss(optimizer_gen, loss)
+        gradients_gen = unscale_gradients(
+            optimizer_gen,
+            tape_gen.gradient(scaled_loss, generator.trainable_variables),
+        )
 
     optimizer_gen.apply_gradients(zip(gradients_gen, generator.trainable_variables))
 
+    if return_generated:
+        return loss, generated
     return loss
 
 
-def train_model(  # pylint: disable=R0912,R0913,R0914,R0915
-    config, generator, data_train, data_valid, run_path, noise_dim, add_weather, shuffle
+def build_gan_step(  # pylint: disable=R0913,R0915
+    generator,
+    optimizer_gen,
+    noise_dim,
+    add_weather,
+    batch_size=None,
+    jit_compile=False,
+    return_generated=False,
+    metrics=None,
+    strategy=None,
+    accumulate_steps=1,
 ):
-
-    data_train = Batcher(
-        data_train, batch_size=32, add_weather=add_weather, shuffle=shuffle
-    )
-    data_valid = Batcher(
-        data_valid, batch_size=32, add_weather=add_weather, shuffle=shuffle
-    )
-
-    mlflow.set_tracking_uri(run_path + "/mlruns")
-    mlflow.set_experiment("Aldernet")
-    tune_trial = tune.get_trial_name() + "/"
-    Path(run_path + "/viz/" + tune_trial).mkdir(parents=True, exist_ok=True)
-    Path(run_path + "/viz/valid/" + tune_trial).mkdir(parents=True, exist_ok=True)
-
-    epoch = tf.Variable(1, dtype="int64")
-    step = tf.Variable(1, dtype="int64")
-    step_valid = 1
-
-    # betas need to be floats, or checkpoint restoration fails
-    optimizer_gen = tf.keras.optimizers.Adam(
-        learning_rate=config["learning_rate"],
-        beta_1=config["beta_1"],
-        beta_2=config["beta_2"],
-        epsilon=1e-08,
-    )
-
-    while True:
-        start = time.time()
-        loss_report = np.zeros(0)
-        loss_valid = np.zeros(0)
-        if not add_weather:
-            for i in range(math.floor(data_train.x.shape[0] / data_train.batch_size)):
-
-                hazel_train = data_train[i][0]
-                alder_train = data_train[i][1]
-
-                print(epoch.numpy(), "-", step.numpy(), flush=True)
-
-                loss_report = np.append(
-                    loss_report,
-                    gan_step(
-                        generator,
-                        optimizer_gen,
-                        hazel_train,
-                        alder_train,
-                        None,
-                        noise_dim,
-                        add_weather,
-                    ).numpy(),
+    """Compile ``gan_step`` once for one generator configuration.
+
+    The returned function takes ``(input_train, target_train, weather_train=None,
+    sample_weight=None)`` and is traced once; a static ``batch_size`` lets XLA
+    specialise with ``jit_compile``. With ``return_generated`` it also returns the
+    generated batch. Under a ``strategy`` the batch is split over the replicas, and
+    with ``accumulate_steps=n`` the update is applied with every ``n``-th call.
+    """
+    assemble = generator_inputs(noise_dim, add_weather, noise_shape(generator))
+    shapes = dict(zip(generator.input_names, generator.inputs))
+    specs = [
+        tf.TensorSpec([batch_size, *shapes["image_input"].shape[1:]], tf.float32),
+        tf.TensorSpec([batch_size, *generator.output_shape[1:]], tf.float32),
+    ]
+    if add_weather:
+        specs.append(
+            tf.TensorSpec([batch_size, *shapes["weather_input"].shape[1:]], tf.float32)
+        )
+    specs.append(tf.TensorSpec([batch_size], tf.float32))
+
+    if accumulate_steps > 1:
+        # Replica-local sums, only aggregated by ``apply_gradients``
+        with strategy.scope() if strategy is not None else contextlib.nullcontext():
+            accumulated = [
+                tf.Variable(
+                    tf.zeros(variable.shape, variable.dtype),
+                    trainable=False,
+                    synchronization=tf.VariableSynchronization.ON_READ,
+                    aggregation=tf.VariableAggregation.SUM,
                 )
-                if noise_dim > 0:
-                    noise_train = tf.random.normal([hazel_train.shape[0], noise_dim])
-                    generated_train = generator([noise_train, hazel_train])
-                else:
-                    generated_train = generator([hazel_train])
-                index = np.random.randint(hazel_train.shape[0])
+                for variable in generator.trainable_variables
+            ]
+            accumulated_weight = tf.Variable(
+                0.0,
+                trainable=False,
+                synchronization=tf.VariableSynchronization.ON_READ,
+                aggregation=tf.VariableAggregation.SUM,
+            )
 
-                viz = (
-                    hazel_train[index],
-                    alder_train[index],
-                    generated_train[index].numpy(),
+    def compute(input_train, target_train, weather_train, sample_weight, weight_total):
+        share = tf.math.reduce_sum(sample_weight) / weight_total
+        with tf.GradientTape() as tape_gen:
+            generated = generator(assemble(input_train, weather_train), training=True)
+            loss = share * l1_loss(generated, target_train, sample_weight)
+            scaled_loss = scale_loss(optimizer_gen, loss)
+        gradients_gen = unscale_gradients(
+            optimizer_gen, tape_gen.gradient(scaled_loss, generator.trainable_variables)
+        )
+        return loss, generated, gradients_gen
+
+    def update(  # pylint: disable=R0913
+        loss, generated, gradients_gen, target_train, sample_weight, weight_total, apply
+    ):
+        if accumulate_steps > 1:
+            for total, gradient in zip(accumulated, gradients_gen):
+                total.assign_add(weight_total * gradient)
+            accumulated_weight.assign_add(weight_total)
+        if apply and accumulate_steps > 1:
+            optimizer_gen.apply_gradients(
+                zip(
+                    [total / accumulated_weight for total in accumulated],
+                    generator.trainable_variables,
                 )
-
-                write_png(
-                    viz,
-                    run_path
-                    + "/viz/"
-                    + tune_trial
-                    + str(epoch.numpy())
-                    + "-"
-                    + str(step.numpy())
-                    + ".png",
-                    pretty=True,
+            )
+            for total in accumulated:
+                total.assign(tf.zeros_like(total))
+            accumulated_weight.assign(0.0)
+        elif apply:
+            optimizer_gen.apply_gradients(
+                zip(gradients_gen, generator.trainable_variables)
+            )
+        if metrics is not None:
+            metrics.update(generated, target_train, sample_weight)
+        if return_generated:
+            return loss, generated
+        return loss
+
+    # XLA compiles the forward and backward pass of each replica, while the
+    # gradients are aggregated across replicas outside of it, when applied
+    compute_replica = tf.function(compute, jit_compile=jit_compile)
+
+    def make_step(apply):
+        if strategy is None:
+
+            @tf.function(input_signature=specs, jit_compile=jit_compile)
+            def step(input_train, target_train, *weather_and_weight):
+                weather_train = weather_and_weight[0] if add_weather else None
+                sample_weight = weather_and_weight[-1]
+                weight_total = tf.math.reduce_sum(sample_weight)
+                return update(
+                    *compute(
+                        input_train,
+                        target_train,
+                        weather_train,
+                        sample_weight,
+                        weight_total,
+                    ),
+                    target_train,
+                    sample_weight,
+                    weight_total,
+                    apply,
                 )
 
-                step.assign_add(1)
+            return step
 
-            print(
-                f"Time taken for epoch {epoch.numpy()} is {time.time() - start} sec\n",
-                flush=True,
+        def replica_step(input_train, target_train, *weather_and_weight):
+            weather_train = weather_and_weight[0] if add_weather else None
+            sample_weight = weather_and_weight[-1]
+            weight_total = tf.distribute.get_replica_context().all_reduce(
+                "sum", tf.math.reduce_sum(sample_weight)
             )
-
-            for i in range(math.floor(data_valid.x.shape[0] / data_valid.batch_size)):
-
-                hazel_valid = data_valid[i][0]
-                alder_valid = data_valid[i][1]
-
-                if noise_dim > 0:
-                    noise_valid = tf.random.normal([hazel_valid.shape[0], noise_dim])
-                    generated_valid = generator([noise_valid, hazel_valid])
-                else:
-                    generated_valid = generator([hazel_valid])
-                index = np.random.randint(hazel_valid.shape[0])
-                viz = (
-                    hazel_valid[index],
-                    alder_valid[index],
-                    generated_valid[index].numpy(),
-                )
-                write_png(
-                    viz,
-                    run_path
-                    + "/viz/valid/"
-                    + tune_trial
-                    + str(epoch.numpy())
-                    + "-"
-                    + str(step_valid)
-                    + ".png",
-                    pretty=True,
-                )
-                step_valid += 1
-                loss_valid = np.append(
-                    loss_valid,
-                    tf.math.reduce_mean(
-                        tf.math.abs(generated_valid - alder_valid)
-                    ).numpy(),
-                )
-            air.session.report(
-                {
-                    "iterations": step,
-                    "Loss_valid": loss_valid.mean(),
-                    "Loss": loss_report.mean(),
-                }
+            return update(
+                *compute_replica(
+                    input_train,
+                    target_train,
+                    weather_train,
+                    sample_weight,
+                    weight_total,
+                ),
+                target_train,
+                sample_weight,
+                weight_total,
+                apply,
             )
 
-            epoch.assign_add(1)
-            if shuffle:
-                data_train.on_epoch_end()
-                data_valid.on_epoch_end()
-
-            for i in range(math.floor(data_valid.x.shape[0] / data_valid.batch_size)):
-
-                hazel_valid = data_valid[i][0]
-                alder_valid = data_valid[i][1]
-
-                if noise_dim > 0:
-                    noise_valid = tf.random.normal([hazel_valid.shape[0], noise_dim])
-                    generated_valid = generator([noise_valid, hazel_valid])
-                else:
-                    generated_valid = generator([hazel_valid])
-                index = np.random.randint(hazel_valid.shape[0])
-                viz = (
-                    hazel_valid[index],
-                    alder_valid[index],
-                    generated_valid[index].numpy(),
-                )
-                write_png(
-                    viz,
-                    run_path
-                    + "/viz/valid/"
-                    + tune_trial
-                    + str(epoch.numpy())
-                    + "-"
-                    + str(step_valid)
-                    + ".png",
-                    pretty=True,
+        @tf.function
+        def step(*arrays):
+            results = strategy.run(replica_step, args=arrays)
+            loss = results[0] if return_generated else results
+            loss = strategy.reduce("sum", loss, axis=None)
+            if return_generated:
+                return loss, tf.concat(
+                    strategy.experimental_local_results(results[1]), 0
                 )
-                step_valid += 1
-                loss_valid = np.append(
-                    loss_valid,
-                    tf.math.reduce_mean(
-                        tf.math.abs(generated_valid - alder_valid)
-                    ).numpy(),
-                )
-            air.session.report(
-                {
-                    "iterations": step,
-                    "Loss_valid": loss_valid.mean(),
-                    "Loss": loss_report.mean(),
-                }
-            )
-            loss_valid = tf.math.reduce_sum(tf.math.abs(generated_valid - alder_valid))
-            air.session.report({"Loss_valid": loss_valid})
+            return loss
 
-            epoch.assign_add(1)
-            if shuffle:
-                data_train.on_epoch_end()
-                data_valid.on_epoch_end()
+        return step
 
-            for i in range(math.floor(data_valid.x.shape[0] / data_valid.batch_size)):
+    apply_step = make_step(apply=True)
+    accumulate_step = make_step(apply=False) if accumulate_steps > 1 else None
+    calls = itertools.count(1)
 
-                hazel_valid = data_valid[i][0]
-                alder_valid = data_valid[i][1]
+    def run_step(input_train, target_train, weather_train=None, sample_weight=None):
+        if sample_weight is None:
+            sample_weight = tf.ones(input_train.shape[0])
+        arrays = [input_train, target_train]
+        if add_weather:
+            arrays.append(weather_train)
+        arrays.append(sample_weight)
+        if strategy is not None:
+            arrays = distribute_batch(strategy, *arrays)
+        if next(calls) % accumulate_steps == 0:
+            return apply_step(*arrays)
+        return accumulate_step(*arrays)
 
-                if noise_dim > 0:
-                    noise_valid = tf.random.normal([hazel_valid.shape[0], noise_dim])
-                    generated_valid = generator([noise_valid, hazel_valid])
-                else:
-                    generated_valid = generator([hazel_valid])
-                index = np.random.randint(hazel_valid.shape[0])
-                viz = (
-                    hazel_valid[index],
-                    alder_valid[index],
-                    generated_valid[index].numpy(),
-                )
-                write_png(
-                    viz,
-                    run_path
-                    + "/viz/valid/"
-                    + tune_trial
-                    + str(epoch.numpy())
-                    + "-"
-                    + str(step_valid)
-                    + ".png",
-                    pretty=True,
-                )
-                step_valid += 1
-                loss_valid = np.append(
-                    loss_valid,
-                    tf.math.reduce_mean(
-                        tf.math.abs(generated_valid - alder_valid)
-                    ).numpy(),
-                )
-            air.session.report(
-                {
-                    "iterations": step,
-                    "Loss_valid": loss_valid.mean(),
-                    "Loss": loss_report.mean(),
-                }
-            )
-            loss_valid = tf.math.reduce_sum(tf.math.abs(generated_valid - alder_valid))
-            air.session.report({"Loss_valid": loss_valid})
+    return run_step
 
-            epoch.assign_add(1)
-            if shuffle:
-                data_train.on_epoch_end()
-                data_valid.on_epoch_end()
 
-            for i in range(math.floor(data_valid.x.shape[0] / data_valid.batch_size)):
+def train_model(  # pylint: disable=R0912,R0913,R0914,R0915
+    config,
+    generator,
+    data_train,
+    data_valid,
+    run_path,
+    noise_dim,
+    add_weather,
+    shuffle,
+    buffer_chunks=None,
+    prefetch_workers=0,
+    valid_cache_bytes=None,
+    valid_cache_dir=None,
+    patch_size=None,
+    patch_bias=0.0,
+    context=1,
+    importance_exponent=None,
+    jit_compile=False,
+    eval_every_steps=None,
+    eval_every_epochs=1,
+    valid_batches=None,
+    viz_every_steps=None,
+    viz_per_epoch=None,
+    viz_pretty=True,
+    viz_mode="steps",
+    viz_samples=8,
+    viz_gif=False,
+    checkpoint_every=1,
+    distribute=None,
+    accumulate_steps=1,
+):
+    """Train the generator and report to Ray Tune after every evaluation.
+
+    Evaluates every ``eval_every_steps`` steps and/or ``eval_every_epochs`` epochs and
+    reports L1, L2 and bias on training and validation, the ``iterations`` and the
+    fractional ``epoch``. Every ``checkpoint_every``-th report is checkpointed; a
+    restored trial resumes mid-epoch with the same seeded sample order.
+    ``config["batch_size"]`` samples make one optimizer step, read in
+    ``accumulate_steps`` micro-batches (the counted steps) of a static size, split
+    over the workers and replicas of ``distribute``. Images are written with each
+    evaluation unless ``viz_every_steps`` or ``viz_per_epoch`` say otherwise.
+    """
+    strategy = distribution_strategy(distribute)
+    shard = worker_shard(strategy)
+    micro_batch = config.get("batch_size", 32) // (shard[1] * accumulate_steps)
 
-                hazel_valid = data_valid[i][0]
-                alder_valid = data_valid[i][1]
+    data_train = Batcher(
+        data_train,
+        batch_size=micro_batch,
+        add_weather=add_weather,
+        shuffle=shuffle,
+        buffer_chunks=buffer_chunks,
+        patch_size=patch_size,
+        patch_bias=patch_bias,
+        context=context,
+        remainder="drop",
+        importance_exponent=importance_exponent,
+        shard=shard,
+    )
+    if valid_cache_bytes is not None:
+        # Validation is identical every epoch: decode it once and serve from cache
+        valid_cache = ChunkCache(valid_cache_bytes, spill_dir=valid_cache_dir)
+    else:
+        valid_cache = None
+    data_valid = Batcher(
+        data_valid,
+        batch_size=micro_batch,
+        add_weather=add_weather,
+        shuffle=shuffle,
+        buffer_chunks=buffer_chunks,
+        cache=valid_cache,
+        patch_size=patch_size,
+        context=context,
+        remainder="drop",
+        shard=shard,
+    )
+
+    mlflow.set_tracking_uri(run_path + "/mlruns")
+    mlflow.set_experiment("Aldernet")
+    tune_trial = tune.get_trial_name() + "/"
+    if viz_mode == "sheet":
+        # Only the contact sheets are written, not the per-step images
+        viz_every_steps, viz_per_epoch = 0, None
+    elif viz_every_steps is None and viz_per_epoch is None:
+        # Copying a prediction off the device stalls the step; keep it to reports
+        if eval_every_steps:
+            viz_every_steps = eval_every_steps
+        else:
+            viz_per_epoch = 1
+    viz_train = VizWriter(
+        run_path + "/viz/" + tune_trial,
+        every_steps=viz_every_steps,
+        per_epoch=viz_per_epoch,
+        pretty=viz_pretty,
+    )
+    viz_valid = VizWriter(
+        run_path + "/viz/valid/" + tune_trial,
+        every_steps=viz_every_steps,
+        per_epoch=viz_per_epoch,
+        pretty=viz_pretty,
+    )
+    viz_sheets = VizWriter(
+        run_path + "/viz/sheets/" + tune_trial,
+        columns=math.ceil(math.sqrt(viz_samples)),
+        gif=viz_gif,
+    )
+    if viz_mode == "sheet":
+        # Evenly spread over the validation period, with noise fixed across epochs
+        tracked = split_batch(
+            data_valid.take(
+                data_valid.samples[
+                    np.linspace(0, len(data_valid.samples) - 1, viz_samples)
+                    .round()
+                    .astype(int)
+                ]
+            ),
+            add_weather,
+        )
+        tracked_inputs = generator_inputs(
+            noise_dim, add_weather, noise_shape(generator)
+        )(tracked[0], tracked[1])
+
+    epoch = 1
+    step = 1
+    # Batches of the current epoch trained on, to resume in the middle of one
+    position = 0
+    # Seeds the training order of every epoch, so that a resumed epoch continues
+    # in the same order; all workers of a trial share its name
+    seed = zlib.crc32(tune_trial.encode())
+    # The loop counts in Python, without waiting for the device; the checkpointed
+    # copies of the counters are only updated before saving
+    counters = dict(
+        epoch=tf.Variable(epoch, dtype="int64"),
+        step=tf.Variable(step, dtype="int64"),
+        position=tf.Variable(position, dtype="int64"),
+        seed=tf.Variable(seed, dtype="int64"),
+    )
+    step_valid = 1
+    reports = 0
+    reported_at = 0
+
+    with strategy.scope():
+        if distribute is not None:
+            # Recreate the generator's variables as mirrored variables
+            weights = generator.get_weights()
+            generator = tf.keras.models.clone_model(generator)
+            generator.set_weights(weights)
+        if accumulate_steps > 1:
+            # The moving statistics advance with every micro-batch
+            for layer in batch_norm_layers(generator):
+                layer.momentum = layer.momentum ** (1 / accumulate_steps)
+        # betas need to be floats, or checkpoint restoration fails
+        optimizer_gen = tf.keras.optimizers.Adam(
+            learning_rate=config["learning_rate"],
+            beta_1=config["beta_1"],
+            beta_2=config["beta_2"],
+            epsilon=1e-08,
+        )
+        if config.get("precision") == "mixed_float16":
+            # Scale the loss so that small float16 gradients do not underflow
+            optimizer_gen = tf.keras.mixed_precision.LossScaleOptimizer(optimizer_gen)
+        metrics_train = PollenMetrics()
+        metrics_valid = PollenMetrics("_valid")
+    train_step = build_gan_step(
+        generator,
+        optimizer_gen,
+        noise_dim,
+        add_weather,
+        batch_size=data_train.batch_size,
+        jit_compile=jit_compile,
+        return_generated=True,
+        metrics=metrics_train,
+        strategy=strategy if distribute is not None else None,
+        accumulate_steps=accumulate_steps,
+    )
 
-                if noise_dim > 0:
-                    noise_valid = tf.random.normal([hazel_valid.shape[0], noise_dim])
-                    generated_valid = generator([noise_valid, hazel_valid])
-                else:
-                    generated_valid = generator([hazel_valid])
+    checkpoint = tf.train.Checkpoint(
+        generator=generator,
+        optimizer=optimizer_gen,
+        **counters,
+    )
+    # All workers save, but only the first one where Tune picks it up
+    manager = tf.train.CheckpointManager(
+        checkpoint,
+        run_path + "/checkpoints/" + tune_trial
+        if shard[0] == 0
+        else tempfile.mkdtemp(prefix="aldernet-checkpoint-"),
+        max_to_keep=1,
+    )
+    resume = air.session.get_checkpoint()
+    if resume is not None:
+        if hasattr(optimizer_gen, "build"):
+            # Create the optimizer slots first, so that they are restored right
+            # away; older optimizers restore them when they are created
+            optimizer_gen.build(generator.trainable_variables)
+        checkpoint.restore(
+            tf.train.latest_checkpoint(resume.to_directory())
+        ).assert_existing_objects_matched()
+        epoch, step, position, seed = (
+            int(counter.numpy()) for counter in counters.values()
+        )
+        if position >= len(data_train):
+            epoch += 1
+            position = 0
+        if shuffle and epoch > 1:
+            data_valid.on_epoch_end()
+
+    assemble = generator_inputs(noise_dim, add_weather, noise_shape(generator))
+
+    @tf.function
+    def predict_replica(input_valid, target_valid, weather_valid, weight_valid):
+        generated = generator(assemble(input_valid, weather_valid))
+        metrics_valid.update(generated, target_valid, weight_valid)
+        return generated
+
+    @tf.function
+    def predict(*arrays):
+        if distribute is None:
+            return predict_replica(*arrays)
+        generated = strategy.run(predict_replica, args=arrays)
+        return tf.concat(strategy.experimental_local_results(generated), 0)
+
+    def validate():
+        """Run (a subsample of) the validation set through ``metrics_valid``."""
+        nonlocal step_valid
+        batches = min(len(data_valid), valid_batches or len(data_valid))
+        for i, batch in enumerate(
+            data_valid.prefetch(prefetch_workers, batches=valid_batches)
+        ):
+            hazel_valid, weather_valid, alder_valid, weight_valid = split_batch(
+                batch, add_weather
+            )
+            arrays = hazel_valid, alder_valid, weather_valid, weight_valid
+            if distribute is not None:
+                arrays = distribute_batch(strategy, *arrays)
+            generated_valid = predict(*arrays)
+            if viz_valid.due(step_valid, i, batches):
                 index = np.random.randint(hazel_valid.shape[0])
                 viz = (
-                    hazel_valid[index],
+                    latest_input(hazel_valid, context)[index],
                     alder_valid[index],
                     generated_valid[index].numpy(),
                 )
-                write_png(
-                    viz,
-                    run_path
-                    + "/viz/valid/"
-                    + tune_trial
-                    + str(epoch.numpy())
-                    + "-"
-                    + str(step_valid)
-                    + ".png",
-                    pretty=True,
-                )
-                step_valid += 1
-                loss_valid = np.append(
-                    loss_valid,
-                    tf.math.reduce_mean(
-                        tf.math.abs(generated_valid - alder_valid)
-                    ).numpy(),
-                )
+                viz_valid.submit(viz, epoch, str(step_valid))
+            step_valid += 1
+
+    def report():
+        """Validate and report the metrics accumulated since the last report."""
+        nonlocal reports, reported_at
+        metrics_valid.reset()
+        validate()
+        results = {**metrics_train.result(), **metrics_valid.result()}
+        results.update(
+            iterations=step - 1,
+            # Epochs trained, fractional between epochs, to schedule trials on
+            epoch=epoch - 1 + position / len(data_train),
+            Loss=results["L1"],
+            Loss_valid=results["L1_valid"],
+        )
+        reports += 1
+        reported_at = step
+        if checkpoint_every and reports % checkpoint_every == 0:
+            counters["epoch"].assign(epoch)
+            counters["step"].assign(step)
+            counters["position"].assign(position)
+            manager.save(checkpoint_number=step)
             air.session.report(
-                {
-                    "iterations": step,
-                    "Loss_valid": loss_valid.mean(),
-                    "Loss": loss_report.mean(),
-                }
+                results, checkpoint=air.Checkpoint.from_directory(manager.directory)
             )
-            loss_valid = tf.math.reduce_sum(tf.math.abs(generated_valid - alder_valid))
-            air.session.report({"Loss_valid": loss_valid})
-
-            epoch.assign_add(1)
-            if shuffle:
-                data_train.on_epoch_end()
-                data_valid.on_epoch_end()
-
         else:
-            start = time.time()
-            for i in range(math.floor(data_train.x.shape[0] / data_train.batch_size)):
-
-                hazel_train = data_train[i][0]
-                weather_train = data_train[i][1]
-                alder_train = data_train[i][2]
+            air.session.report(results)
+        metrics_train.reset()
 
-                print(epoch.numpy(), "-", step.numpy(), flush=True)
-
-                loss_report = np.append(
-                    loss_report,
-                    gan_step(
-                        generator,
-                        optimizer_gen,
-                        hazel_train,
-                        alder_train,
-                        weather_train,
-                        noise_dim,
-                        add_weather,
-                    ).numpy(),
+    try:
+        while True:
+            start = time.time()
+            if shuffle or importance_exponent is not None:
+                # Reshuffle and/or redraw the importance samples
+                data_train.on_epoch_end(seed=(seed, epoch))
+            for i, batch in enumerate(
+                data_train.prefetch(prefetch_workers, start=position), start=position
+            ):
+                hazel_train, weather_train, alder_train, weight_train = split_batch(
+                    batch, add_weather
                 )
-                if noise_dim > 0:
-                    noise_train = tf.random.normal([hazel_train.shape[0], noise_dim])
-                    generated_train = generator(
-                        [noise_train, hazel_train, weather_train]
-                    )
-                else:
-                    generated_train = generator([hazel_train, weather_train])
-                index = np.random.randint(hazel_train.shape[0])
 
-                viz = (
-                    hazel_train[index],
-                    alder_train[index],
-                    generated_train[index].numpy(),
-                )
-                write_png(
-                    viz,
-                    run_path
-                    + "/viz/"
-                    + tune_trial
-                    + str(epoch.numpy())
-                    + "-"
-                    + str(step.numpy())
-                    + ".png",
-                    pretty=True,
+                # Reuse the training forward pass for the visualisation
+                _, generated_train = train_step(
+                    hazel_train, alder_train, weather_train, sample_weight=weight_train
                 )
+                if viz_train.due(step, i, len(data_train)):
+                    index = np.random.randint(hazel_train.shape[0])
+                    viz = (
+                        latest_input(hazel_train, context)[index],
+                        alder_train[index],
+                        generated_train[index].numpy(),
+                    )
+                    viz_train.submit(viz, epoch, str(step))
 
-                step.assign_add(1)
+                step += 1
+                position = i + 1
+                if eval_every_steps and (step - 1) % eval_every_steps == 0:
+                    report()
 
             print(
-                f"Time taken for epoch {epoch.numpy()} is {time.time() - start} sec\n",
+                f"Time taken for epoch {epoch} is {time.time() - start} sec\n",
                 flush=True,
             )
 
-            for i in range(math.floor(data_valid.x.shape[0] / data_valid.batch_size)):
-
-                hazel_valid = data_valid[i][0]
-                weather_valid = data_valid[i][1]
-                alder_valid = data_valid[i][2]
-
-                if noise_dim > 0:
-                    noise_valid = tf.random.normal([hazel_valid.shape[0], noise_dim])
-                    generated_valid = generator(
-                        [noise_valid, hazel_valid, weather_valid]
-                    )
-                else:
-                    generated_valid = generator([hazel_valid, weather_valid])
-                index = np.random.randint(hazel_valid.shape[0])
-                viz = (
-                    hazel_valid[index],
-                    alder_valid[index],
-                    generated_valid[index].numpy(),
-                )
-                write_png(
-                    viz,
-                    run_path
-                    + "/viz/valid/"
-                    + tune_trial
-                    + str(epoch.numpy())
-                    + "-"
-                    + str(step_valid)
-                    + ".png",
-                    pretty=True,
+            # Unless the last step of the epoch was just reported
+            if (
+                eval_every_epochs
+                and epoch % eval_every_epochs == 0
+                and reported_at != step
+            ):
+                report()
+            if viz_mode == "sheet":
+                viz_sheets.submit_sheet(
+                    latest_input(tracked[0], context),
+                    tracked[2],
+                    generator(tracked_inputs, training=False).numpy(),
+                    epoch,
                 )
-                loss_valid = np.append(
-                    loss_valid,
-                    tf.math.reduce_mean(
-                        tf.math.abs(generated_valid - alder_valid)
-                    ).numpy(),
-                )
-                step_valid += 1
-            air.session.report(
-                {
-                    "iterations": step,
-                    "Loss_valid": loss_valid.mean(),
-                    "Loss": loss_report.mean(),
-                }
-            )
-            epoch.assign_add(1)
+            epoch += 1
+            position = 0
             if shuffle:
-                data_train.on_epoch_end()
                 data_valid.on_epoch_end()
+    finally:
+        viz_train.close()
+        viz_valid.close()
+        viz_sheets.close()
+        if valid_cache is not None:
+            valid_cache.close()
+
+
+def sample_mae(target, prediction):
+    """Mean absolute error of each sample, for per-sample ``sample_weight``."""
+    return tf.math.reduce_mean(tf.math.abs(prediction - target), axis=[1, 2, 3])
 
 
 def train_model_simple(  # pylint: disable=R0914,R0915
@@ -689,6 +1178,8 @@ def train_model_simple(  # pylint: disable=R0914,R0915
     )
     # Build U-Net model
     s = tf.keras.layers.Lambda(lambda x: x / 255)(inputs)
+    # Four poolings: pad to a multiple of 16, crop the output back
+    padding = stride_padding(data_train.x.shape[1], data_train.x.shape[2], 16)
 
     if conv:
         c1 = tf.keras.layers.Conv2D(
@@ -697,7 +1188,7 @@ def train_model_simple(  # pylint: disable=R0914,R0915
             activation=tf.keras.activations.elu,
             kernel_initializer="he_normal",
             padding="same",
-        )(s)
+        )(ReflectPad2D(padding)(s))
         c1 = tf.keras.layers.Dropout(0.1)(c1)
         c1 = tf.keras.layers.Conv2D(
             16,
@@ -778,8 +1269,6 @@ def train_model_simple(  # pylint: disable=R0914,R0915
         u6 = tf.keras.layers.Conv2DTranspose(
             128, (2, 2), strides=(2, 2), padding="same"
         )(c5)
-        if u6.shape != c4.shape:
-            u6 = layers.Cropping2D(cropping=((1, 0), (1, 0)), data_format=None)(u6)
         u6 = tf.keras.layers.concatenate([u6, c4])
         c6 = tf.keras.layers.Conv2D(
             128,
@@ -800,8 +1289,6 @@ def train_model_simple(  # pylint: disable=R0914,R0915
         u7 = tf.keras.layers.Conv2DTranspose(
             64, (2, 2), strides=(2, 2), padding="same"
         )(c6)
-        if u7.shape != c3.shape:
-            u7 = layers.Cropping2D(cropping=((1, 0), (1, 0)), data_format=None)(u7)
         u7 = tf.keras.layers.concatenate([u7, c3])
         c7 = tf.keras.layers.Conv2D(
             64,
@@ -822,8 +1309,6 @@ def train_model_simple(  # pylint: disable=R0914,R0915
         u8 = tf.keras.layers.Conv2DTranspose(
             32, (2, 2), strides=(2, 2), padding="same"
         )(c7)
-        if u8.shape != c2.shape:
-            u8 = layers.Cropping2D(cropping=((1, 0), (1, 0)), data_format=None)(u8)
         u8 = tf.keras.layers.concatenate([u8, c2])
         c8 = tf.keras.layers.Conv2D(
             32,
@@ -844,8 +1329,6 @@ def train_model_simple(  # pylint: disable=R0914,R0915
         u9 = tf.keras.layers.Conv2DTranspose(
             16, (2, 2), strides=(2, 2), padding="same"
         )(c8)
-        if u9.shape != c1.shape:
-            u9 = layers.Cropping2D(cropping=((1, 0), (1, 0)), data_format=None)(u9)
         u9 = tf.keras.layers.concatenate([u9, c1], axis=3)
         c9 = tf.keras.layers.Conv2D(
             16,
@@ -863,6 +1346,7 @@ def train_model_simple(  # pylint: disable=R0914,R0915
             padding="same",
         )(c9)
 
+        c9 = layers.Cropping2D(padding)(c9)
         outputs = tf.keras.layers.Conv2D(1, (1, 1), activation="sigmoid")(c9)
 
         model = tf.keras.Model(inputs=[inputs], outputs=[outputs])
@@ -890,25 +1374,26 @@ def train_model_simple(  # pylint: disable=R0914,R0915
                 strides=1,
                 padding="same",
                 use_bias=False,
-                # kernel_constraint=SpectralNormalization()
             )
         )
         model.add(layers.Dense(1, activation="linear"))
     model.summary()
 
+    # Per-sample MAE, so that the padding mask of the Batchers applies per sample
     model.compile(
-        loss="mean_absolute_error",
+        loss=sample_mae,
         optimizer=tf.keras.optimizers.Adam(learning_rate=1e-4),
-        metrics=["mae"],
+        metrics=[tf.keras.metrics.MeanMetricWrapper(sample_mae, name="mae")],
     )
 
     model.fit(data_train, epochs=epochs)
-    predictions = model.predict(data_valid)
+    # Drop the predictions for the padding of the last batch
+    predictions = model.predict(data_valid)[: len(data_valid.order)]
     for timestep in range(0, predictions.shape[0], 100):
         write_png(
             (
-                data_valid.x[timestep].values,
-                data_valid.y[timestep].values,
+                data_valid.x[data_valid.order[timestep]].values,
+                data_valid.y[data_valid.order[timestep]].values,
                 predictions[timestep],
             ),
             path=str(here()) + "/output/prediction" + str(timestep) + ".png",
@@ -0,0 +1,268 @@
+"""Visualise pollen fields written during training."""
+
+# Copyright (c) 2022 MeteoSwiss, contributors listed in AUTHORS
+# Distributed under the terms of the BSD 3-Clause License.
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Standard library
+import logging
+import multiprocessing
+import queue
+import struct
+import zlib
+from pathlib import Path
+
+# Third-party
+import matplotlib.pyplot as plt  # type: ignore
+import numpy as np
+from PIL import Image  # type: ignore
+
+# Viridis as a 256-entry RGB lookup table, the colormap of the matplotlib plots
+VIRIDIS = (plt.get_cmap("viridis")(np.linspace(0, 1, 256))[:, :3] * 255).round()
+VIRIDIS = VIRIDIS.astype(np.uint8)
+
+logger = logging.getLogger(__name__)
+
+
+def colorize(fields, vmin, vmax, lut=VIRIDIS):
+    """Map ``fields`` to RGB through ``lut``, scaled between ``vmin`` and ``vmax``.
+
+    ``vmin`` and ``vmax`` broadcast against ``fields``; the result has a trailing
+    axis of size 3 and dtype uint8.
+    """
+    scaled = (fields - vmin) / np.maximum(vmax - vmin, np.finfo(np.float32).tiny)
+    index = np.nan_to_num(scaled * (len(lut) - 1)).clip(0, len(lut) - 1)
+    return lut[index.round().astype(np.intp)]
+
+
+def render_triptychs(inputs, targets, predictions, gap=2, lut=VIRIDIS):
+    """Render a batch of input/target/prediction triptychs as RGB images.
+
+    The arguments have shape (batch, height, width, channel); the first channel
+    is shown. The three panels of a triptych share one colour scale and are
+    separated by ``gap`` white columns. Returns (batch, height, width', 3) uint8.
+    """
+    panels = np.stack(
+        [
+            np.asarray(field, np.float32)[..., 0]
+            for field in (inputs, targets, predictions)
+        ],
+        axis=1,
+    )
+    vmin = panels.min(axis=(1, 2, 3), keepdims=True)
+    vmax = panels.max(axis=(1, 2, 3), keepdims=True)
+    rgb = colorize(panels, vmin, vmax, lut)
+    rgb = np.pad(rgb, [(0, 0)] * 3 + [(0, gap), (0, 0)], constant_values=255)
+    batch, _, height, width, _ = rgb.shape
+    rgb = rgb.transpose(0, 2, 1, 3, 4).reshape(batch, height, 3 * width, 3)
+    return rgb[:, :, : rgb.shape[2] - gap]
+
+
+def encode_png(rgb, level=1):
+    """Encode a (height, width, 3) uint8 image as PNG bytes."""
+    height, width, _ = rgb.shape
+    # Every scanline starts with its filter type, 0 (none)
+    raw = np.zeros((height, 1 + 3 * width), np.uint8)
+    raw[:, 1:] = rgb.reshape(height, -1)
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(raw.tobytes(), level)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+def write_png(image, path, pretty):
+
+    if pretty:
+
+        minmin = min(image[0].min(), image[1].min(), image[2].min())
+        maxmax = max(image[0].max(), image[1].max(), image[2].max())
+
+        fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(10, 2.1), dpi=150)
+        ax1.imshow(
+            image[0][:, :, 0], cmap="viridis", vmin=minmin, vmax=maxmax, aspect="auto"
+        )
+        ax2.imshow(
+            image[1][:, :, 0], cmap="viridis", vmin=minmin, vmax=maxmax, aspect="auto"
+        )
+        im3 = ax3.imshow(
+            image[2][:, :, 0], cmap="viridis", vmin=minmin, vmax=maxmax, aspect="auto"
+        )
+        for ax in (ax1, ax2, ax3):
+            ax.axes.xaxis.set_visible(False)
+            ax.axes.yaxis.set_visible(False)
+        ax1.axes.set_title("Input")
+        ax2.axes.set_title("Target")
+        ax3.axes.set_title("Prediction")
+        fig.subplots_adjust(right=0.85, top=0.85)
+        cbar_ax = fig.add_axes([0.88, 0.15, 0.04, 0.7])
+        fig.colorbar(im3, cax=cbar_ax)
+        plt.savefig(path)
+        plt.close(fig)
+    else:
+        rgb = render_triptychs(*(np.asarray(field)[np.newaxis] for field in image))
+        Path(path).write_bytes(encode_png(rgb[0]))
+
+
+def contact_sheet(rgb, columns=1, gap=8):
+    """Tile a batch of (height, width, 3) images into a grid of ``columns``."""
+    batch, height, width, _ = rgb.shape
+    rows = -(-batch // columns)
+    blank = np.full((rows * columns - batch, height, width, 3), 255, np.uint8)
+    rgb = np.pad(
+        np.concatenate([rgb, blank]),
+        [(0, 0), (0, gap), (0, gap), (0, 0)],
+        constant_values=255,
+    )
+    sheet = rgb.reshape(rows, columns, height + gap, width + gap, 3)
+    sheet = sheet.transpose(0, 2, 1, 3, 4).reshape(
+        rows * (height + gap), columns * (width + gap), 3
+    )
+    return sheet[: sheet.shape[0] - gap, : sheet.shape[1] - gap]
+
+
+def write_contact_sheet(  # pylint: disable=R0913
+    inputs, targets, predictions, path, columns=1
+):
+    """Write the triptychs of a batch as one contact sheet."""
+    rgb = render_triptychs(inputs, targets, predictions)
+    Path(path).write_bytes(encode_png(contact_sheet(rgb, columns)))
+
+
+def write_gif(paths, path, duration=500):
+    """Write the existing images at ``paths`` as an animated GIF."""
+    frames = [Image.open(frame) for frame in paths if Path(frame).exists()]
+    if frames:
+        frames[0].save(
+            path, save_all=True, append_images=frames[1:], duration=duration, loop=0
+        )
+
+
+def _write_worker(tasks):
+    """Run the write calls from ``tasks`` until the ``None`` sentinel arrives.
+
+    A failing write is logged and skipped, so one bad image does not stop the
+    worker and block the queue for the rest of the training.
+    """
+    for function, kwargs in iter(tasks.get, None):
+        try:
+            Path(kwargs["path"]).parent.mkdir(parents=True, exist_ok=True)
+            function(**kwargs)
+        except Exception:  # pylint: disable=W0703
+            logger.exception("Could not write %s", kwargs["path"])
+
+
+class VizWriter:
+    """Write visualisations in a background process, at a configurable cadence.
+
+    Images due every ``every_steps`` steps or ``per_epoch`` times per epoch go to
+    ``<root>/<epoch>/<name>.png``, and are dropped when the queue is full; contact
+    sheets of ``submit_sheet`` go to ``<root>/<epoch>.png``. The worker is spawned,
+    so a script writing images needs an ``if __name__ == "__main__":`` guard.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        root,
+        every_steps=1,
+        per_epoch=None,
+        queue_size=16,
+        pretty=True,
+        columns=1,
+        gif=False,
+        timeout=60,
+    ):
+        """Initialize."""
+        self.root = Path(root)
+        self.every_steps = every_steps
+        self.per_epoch = per_epoch
+        self.pretty = pretty
+        self.columns = columns
+        self.gif = gif
+        self.timeout = timeout
+        self.sheets = []
+        self.dropped = 0
+        # Forking a process that runs TensorFlow threads can deadlock the child, so
+        # the worker is spawned, which re-runs an unguarded __main__ module
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue(maxsize=queue_size)
+        self.process = context.Process(
+            target=_write_worker, args=(self.tasks,), daemon=True
+        )
+
+    def _put(self, task, block=True):
+        # The worker is only started once there is something to write
+        if self.process.pid is None:
+            self.process.start()
+        elif not self.process.is_alive():
+            raise queue.Full("the visualisation worker has stopped")
+        self.tasks.put(task, block=block, timeout=self.timeout if block else None)
+
+    def due(self, step, batch, batches):
+        """Whether global ``step``, batch ``batch`` of ``batches`` is visualised."""
+        if self.per_epoch is not None:
+            due = np.linspace(0, batches - 1, min(self.per_epoch, batches))
+            return batch in due.round().astype(int)
+        return bool(self.every_steps) and step % self.every_steps == 0
+
+    def submit(self, image, epoch, name):
+        """Queue ``image`` for writing, or drop it if the queue is full."""
+        path = str(self.root / str(epoch) / f"{name}.png")
+        try:
+            self._put(
+                (write_png, dict(image=image, path=path, pretty=self.pretty)),
+                block=False,
+            )
+        except queue.Full:
+            self.dropped += 1
+
+    def submit_sheet(self, inputs, targets, predictions, epoch):
+        """Queue the contact sheet of the tracked samples for ``epoch``."""
+        path = str(self.root / f"{epoch}.png")
+        try:
+            self._put(
+                (
+                    write_contact_sheet,
+                    dict(
+                        inputs=inputs,
+                        targets=targets,
+                        predictions=predictions,
+                        path=path,
+                        columns=self.columns,
+                    ),
+                )
+            )
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Dropped the contact sheet of epoch %s", epoch)
+        else:
+            self.sheets.append(path)
+
+    def close(self):
+        """Write the queued images and stop the worker."""
+        if self.gif and self.sheets:
+            path = str(self.root / "sheets.gif")
+            try:
+                self._put((write_gif, dict(paths=self.sheets, path=path)))
+            except queue.Full:
+                logger.warning("Dropped %s", path)
+        if self.process.pid is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.tasks.put(None, timeout=self.timeout)
+            except queue.Full:
+                pass
+            self.process.join(self.timeout)
+        if self.process.is_alive():
+            logger.warning("Stopping the visualisation worker, writes may be lost")
+            self.process.terminate()
+            self.process.join()
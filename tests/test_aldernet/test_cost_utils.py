@@ -0,0 +1,67 @@
+"""Test module ``aldernet/cost_utils.py``."""
+# Third-party
+import tensorflow as tf  # type: ignore
+from keras import layers
+
+# First-party
+from aldernet.cost_utils import estimate_cost  # type: ignore
+from aldernet.cost_utils import model_cost  # type: ignore
+from aldernet.cost_utils import peak_memory  # type: ignore
+from aldernet.training_utils import compile_generator  # type: ignore
+from aldernet.training_utils import define_filters  # type: ignore
+
+
+def test_conv_cost():
+    inputs = tf.keras.Input(shape=(8, 8, 2))
+    hidden = layers.Conv2D(4, 3, padding="same", use_bias=False)(inputs)
+    outputs = layers.Conv2DTranspose(1, 2, strides=2, use_bias=False)(hidden)
+    cost = model_cost(tf.keras.Model(inputs, outputs))
+    assert cost["params"] == 3 * 3 * 2 * 4 + 2 * 2 * 4
+    assert cost["flops"] == 2 * 8 * 8 * 4 * 3 * 3 * 2 + 2 * 8 * 8 * 4 * 2 * 2
+    assert cost["flops_train"] == 3 * cost["flops"]
+    # The input is freed after the first layer
+    assert cost["activations"] == 4 * (8 * 8 * 4 + 16 * 16)
+    # Training keeps every activation, including the input
+    assert cost["activations_train"] == 4 * (8 * 8 * 2 + 8 * 8 * 4 + 16 * 16)
+
+
+def test_recompute_trades_flops_for_memory():
+    costs = [
+        model_cost(
+            compile_generator(32, 32, 0, 0, define_filters(""), recompute=recompute)
+        )
+        for recompute in ((), ("cbr", "down", "up"))
+    ]
+    assert costs[0]["params"] == costs[1]["params"]
+    assert costs[1]["flops_train"] > costs[0]["flops_train"]
+    assert costs[1]["activations_train"] < costs[0]["activations_train"]
+    assert peak_memory(costs[1], 8) < peak_memory(costs[0], 8)
+
+
+def test_spectral_norm_buffers_are_not_params():
+    plain, normalized = [
+        model_cost(
+            compile_generator(
+                32, 32, 0, 0, define_filters(""), spectral_norm=spectral_norm
+            )
+        )
+        for spectral_norm in ((), ("cbr", "down", "up"))
+    ]
+    assert normalized["params"] == plain["params"]
+    assert normalized["optimizer"] == plain["optimizer"]
+    # The buffers still take memory
+    assert normalized["weights"] > plain["weights"]
+
+
+def test_estimate_cost():
+    generator = compile_generator(32, 32, 2, 4, define_filters(""))
+    weights = generator.get_weights()
+    cost = estimate_cost(generator, batch_size=8, benchmark_batch=2, steps=1)
+    assert cost["params"] == generator.count_params()
+    assert cost["memory"] == peak_memory(cost, 8)
+    assert cost["step_time"] > 0
+    # Timing is opt-in
+    assert "step_time" not in estimate_cost(generator, batch_size=8)
+    # The benchmark trains a copy
+    for before, after in zip(weights, generator.get_weights()):
+        assert (before == after).all()
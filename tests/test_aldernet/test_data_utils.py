@@ -0,0 +1,239 @@
+"""Test module ``aldernet/data/data_utils.py``."""
+# Standard library
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+# First-party
+from aldernet.data.data_utils import Batcher  # type: ignore
+from aldernet.data.data_utils import ChunkCache  # type: ignore
+from aldernet.data.data_utils import importance_probs  # type: ignore
+from aldernet.data.data_utils import pack_channels  # type: ignore
+from aldernet.data.data_utils import select_params  # type: ignore
+
+
+@pytest.fixture(name="data")
+def fixture_data():
+    rng = np.random.default_rng(0)
+    coords = {"valid_time": pd.date_range("2022-03-01", periods=40, freq="3600s")}
+    return xr.Dataset(
+        {
+            param: (
+                ("valid_time", "y", "x"),
+                rng.normal(size=(40, 6, 8)).astype("float32"),
+            )
+            for param in select_params
+        },
+        coords=coords,
+    )
+
+
+def test_pack_channels(data):
+    packed = pack_channels(data, time_chunk=16)["packed"]
+    assert packed.dims == ("valid_time", "y", "x", "channel")
+    assert packed.channel.values[0] == "CORY"
+    assert packed.channel.values[-1] == "ALNU"
+    assert packed.chunks[0] == (16, 16, 8)
+
+
+def test_packed_batches_match_variables(data):
+    plain = Batcher(data, batch_size=8, add_weather=True, shuffle=False)
+    packed = Batcher(pack_channels(data), batch_size=8, add_weather=True, shuffle=False)
+    for expected, actual in zip(plain[2], packed[2]):
+        np.testing.assert_array_equal(expected, actual)
+
+
+def test_packed_reads_skip_weather(data):
+    plain = Batcher(data, batch_size=8, add_weather=False, shuffle=False)
+    packed = Batcher(pack_channels(data), batch_size=8, add_weather=False)
+    assert packed.packed.sizes["var"] == 2
+    packed.order = plain.order
+    for expected, actual in zip(plain[2], packed[2]):
+        np.testing.assert_array_equal(expected, actual)
+
+
+def test_chunk_shuffle_decodes_each_chunk_once(data):
+    batcher = Batcher(
+        pack_channels(data, time_chunk=8),
+        batch_size=4,
+        add_weather=False,
+        buffer_chunks=2,
+    )
+    assert sorted(batcher.order) == list(range(40))
+    decoded = []
+    read_chunk = batcher._decoded_chunk  # pylint: disable=protected-access
+
+    def counting_read(chunk):
+        if chunk not in batcher.cache:
+            decoded.append(chunk)
+        return read_chunk(chunk)
+
+    batcher._decoded_chunk = counting_read  # pylint: disable=protected-access
+    for i in range(len(batcher)):
+        hazel, alder = batcher[i]
+        indices = batcher.order[i * 4 : (i + 1) * 4]
+        np.testing.assert_array_equal(hazel[..., 0], data.CORY.values[indices])
+        np.testing.assert_array_equal(alder[..., 0], data.ALNU.values[indices])
+    assert sorted(decoded) == list(range(5))
+
+
+@pytest.mark.parametrize("workers", [0, 3])
+def test_prefetch_keeps_order(data, workers):
+    batcher = Batcher(data, batch_size=6, add_weather=True, shuffle=True)
+    batches = list(batcher.prefetch(workers, depth=2))
+    assert len(batches) == len(batcher)
+    for idx, batch in enumerate(batches):
+        for expected, actual in zip(batcher[idx], batch):
+            np.testing.assert_array_equal(expected, actual)
+    resumed = list(batcher.prefetch(workers, start=2))
+    assert len(resumed) == len(batcher) - 2
+    np.testing.assert_array_equal(resumed[0][0], batcher[2][0])
+
+
+def test_chunk_cache_spills_to_disk(tmp_path):
+    cache = ChunkCache(max_bytes=400, spill_dir=tmp_path, max_spill_bytes=800)
+    for key in range(4):
+        cache.put(key, [np.full(100, key, dtype="float32")])
+    assert list(cache.memory) == [3]
+    assert list(cache.disk) == [1, 2]
+    assert 0 not in cache
+    np.testing.assert_array_equal(cache.get(1)[0], np.full(100, 1))
+    assert cache.get(0) is None
+    # Caches sharing the directory spill into their own subdirectories
+    other = ChunkCache(max_bytes=0, spill_dir=tmp_path)
+    other.put(1, [np.zeros(100, dtype="float32")])
+    np.testing.assert_array_equal(cache.get(1)[0], np.full(100, 1))
+    assert len(list(tmp_path.iterdir())) == 2
+    cache.close()
+    other.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_chunk_cache_loads_once_for_concurrent_readers():
+    cache = ChunkCache(max_bytes=10**6)
+    loads = []
+
+    def load():
+        loads.append(None)
+        time.sleep(0.1)
+        return [np.zeros(10)]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: cache.get_or_load(0, load), range(4)))
+    assert len(loads) == 1
+    assert all(result[0] is results[0][0] for result in results)
+
+
+def test_cached_batches_match_uncached(data, tmp_path):
+    cache = ChunkCache(max_bytes=0, spill_dir=tmp_path)
+    plain = Batcher(data, batch_size=8, add_weather=True, shuffle=False)
+    cached = Batcher(data, batch_size=8, add_weather=True, shuffle=False, cache=cache)
+    for _ in range(2):
+        for idx in range(len(plain)):
+            for expected, actual in zip(plain[idx], cached[idx]):
+                np.testing.assert_array_equal(expected, actual)
+    assert len(cache.disk) == 1
+
+
+@pytest.mark.parametrize("patch_bias", [0.0, 5.0])
+def test_patches_are_crops_of_the_fields(data, patch_bias):
+    batcher = Batcher(
+        pack_channels(data),
+        batch_size=5,
+        add_weather=False,
+        shuffle=False,
+        patch_size=(4, 4),
+        patch_bias=patch_bias,
+    )
+    hazel, alder = batcher[1]
+    assert hazel.shape == alder.shape == (5, 4, 4, 1)
+    for row, index in enumerate(range(5, 10)):
+        windows = np.lib.stride_tricks.sliding_window_view(
+            data.ALNU.values[index], (4, 4)
+        )
+        assert (windows == alder[row, ..., 0]).all(axis=(-2, -1)).any()
+
+
+def test_patches_read_spatial_chunks(data):
+    batcher = Batcher(
+        pack_channels(data, time_chunk=8, spatial_chunk=(3, 4)),
+        batch_size=5,
+        add_weather=True,
+        shuffle=False,
+        patch_size=(4, 4),
+    )
+    # Crops within one tile, across two and across four tiles
+    offsets = (np.array([0, 2, 1, 2, 0]), np.array([0, 4, 3, 1, 4]))
+    batcher._patch_offsets = lambda count: offsets  # pylint: disable=protected-access
+    hazel, weather, alder = batcher[1]
+    for row, index in enumerate(range(5, 10)):
+        crop = (index, slice(offsets[0][row], offsets[0][row] + 4))
+        crop += (slice(offsets[1][row], offsets[1][row] + 4),)
+        np.testing.assert_array_equal(hazel[row, ..., 0], data.CORY.values[crop])
+        np.testing.assert_array_equal(weather[row, ..., -1], data.V.values[crop])
+        np.testing.assert_array_equal(alder[row, ..., 0], data.ALNU.values[crop])
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_context_windows(data, shuffle):
+    gappy = data.drop_isel(valid_time=[10])
+    batcher = Batcher(
+        pack_channels(gappy),
+        batch_size=4,
+        add_weather=True,
+        shuffle=shuffle,
+        context=3,
+    )
+    assert 10 not in batcher.samples and 11 not in batcher.samples
+    assert len(batcher.samples) == 39 - 2 - 2
+    hazel, weather, alder = batcher[0]
+    assert hazel.shape == (4, 3, 6, 8, 1)
+    assert weather.shape == (4, 3, 6, 8, len(select_params) - 2)
+    assert alder.shape == (4, 6, 8, 1)
+    for row, index in enumerate(batcher.order[:4]):
+        np.testing.assert_array_equal(
+            hazel[row, ..., 0], gappy.CORY.values[index - 2 : index + 1]
+        )
+        np.testing.assert_array_equal(alder[row, ..., 0], gappy.ALNU.values[index])
+
+
+def test_remainder_modes(data):
+    dropped = Batcher(data, batch_size=6, add_weather=False, remainder="drop")
+    assert len(dropped) == 6
+    padded = Batcher(data, batch_size=6, add_weather=False, remainder="pad")
+    assert len(padded) == 7
+    hazel, alder, mask = padded[6]
+    assert hazel.shape == alder.shape == (6, 6, 8, 1)
+    np.testing.assert_array_equal(mask, [1, 1, 1, 1, 0, 0])
+    np.testing.assert_array_equal(hazel[4:], hazel[:2])
+
+
+def test_importance_sampling_weights(data):
+    pollen_mean = np.where(np.arange(40) < 10, 100.0, 0.0)
+    data = data.assign_coords(pollen_mean=("valid_time", pollen_mean))
+    batcher = Batcher(
+        pack_channels(data),
+        batch_size=8,
+        add_weather=False,
+        importance_exponent=1.0,
+    )
+    probs = importance_probs(pollen_mean, 1.0)
+    np.testing.assert_allclose(batcher.sample_probs, probs)
+    assert len(batcher.order) == 40
+    assert np.mean(batcher.order < 10) > 0.5
+    _, _, weight = batcher[0]
+    np.testing.assert_allclose(weight, 1 / (40 * probs[batcher.order[:8]]), rtol=1e-6)
+
+
+def test_worker_shards(data):
+    shards = [
+        Batcher(data, batch_size=4, add_weather=False, shard=(index, 3)).samples
+        for index in range(3)
+    ]
+    assert [len(samples) for samples in shards] == [13, 13, 13]
+    np.testing.assert_array_equal(np.concatenate(shards), np.arange(39))
@@ -0,0 +1,419 @@
+"""Test module ``aldernet/training_utils.py``."""
+# Standard library
+from types import SimpleNamespace
+
+# Third-party
+import numpy as np
+import pandas as pd
+import pytest
+import tensorflow as tf  # type: ignore
+import xarray as xr
+from keras import layers
+
+# First-party
+from aldernet.data.data_utils import Batcher  # type: ignore
+from aldernet.data.data_utils import select_params  # type: ignore
+from aldernet.training_utils import build_gan_step  # type: ignore
+from aldernet.training_utils import compile_generator  # type: ignore
+from aldernet.training_utils import define_filters  # type: ignore
+from aldernet.training_utils import distribution_strategy  # type: ignore
+from aldernet.training_utils import gan_step  # type: ignore
+from aldernet.training_utils import noise_shape  # type: ignore
+from aldernet.training_utils import SpectralNormalization  # type: ignore
+from aldernet.training_utils import tf_setup  # type: ignore
+from aldernet.training_utils import train_model  # type: ignore
+
+# Two logical CPUs to test the distribution strategies, before TensorFlow starts
+tf_setup(cpu_devices=2)
+
+
+@pytest.mark.parametrize("weather_features", [0, 3])
+def test_compiled_step_matches_eager(weather_features):
+    rng = np.random.default_rng(0)
+    hazel = rng.normal(size=(4, 32, 32, 1)).astype("float32")
+    weather = rng.normal(size=(4, 32, 32, 3)).astype("float32")
+    alder = rng.normal(size=(4, 32, 32, 1)).astype("float32")
+    weather = weather if weather_features else None
+    weights = compile_generator(
+        32, 32, weather_features, 0, define_filters("")
+    ).get_weights()
+    losses = []
+    for compiled in (False, True):
+        generator = compile_generator(32, 32, weather_features, 0, define_filters(""))
+        generator.set_weights(weights)
+        optimizer = tf.keras.optimizers.Adam()
+        if compiled:
+            step = build_gan_step(
+                generator, optimizer, 0, weather_features > 0, batch_size=4
+            )
+            losses.append([step(hazel, alder, weather).numpy() for _ in range(2)])
+        else:
+            losses.append(
+                [
+                    gan_step(
+                        generator,
+                        optimizer,
+                        hazel,
+                        alder,
+                        weather,
+                        0,
+                        weather_features > 0,
+                    ).numpy()
+                    for _ in range(2)
+                ]
+            )
+    np.testing.assert_allclose(losses[0], losses[1], rtol=1e-4)
+
+
+def test_step_returns_generated_batch():
+    hazel = np.ones((2, 32, 32, 1), dtype="float32")
+    generator = compile_generator(32, 32, 0, 0, define_filters(""))
+    step = build_gan_step(
+        generator, tf.keras.optimizers.Adam(), 0, False, return_generated=True
+    )
+    # The training forward pass, with the BatchNorm statistics of the batch
+    expected = generator([hazel], training=True).numpy()
+    loss, generated = step(hazel, hazel)
+    np.testing.assert_allclose(generated.numpy(), expected, rtol=1e-5)
+    assert loss.shape == ()
+
+
+@pytest.mark.parametrize("spectral_norm", [(), ("cbr", "down", "up")])
+@pytest.mark.parametrize("policy", ["mixed_bfloat16", "mixed_float16"])
+def test_mixed_precision_step(policy, spectral_norm):
+    hazel = np.random.default_rng(0).normal(size=(2, 32, 32, 1)).astype("float32")
+    tf.keras.mixed_precision.set_global_policy(policy)
+    try:
+        generator = compile_generator(
+            32, 32, 0, 4, define_filters(""), spectral_norm=spectral_norm
+        )
+    finally:
+        tf.keras.mixed_precision.set_global_policy("float32")
+    optimizer = tf.keras.optimizers.Adam()
+    if policy == "mixed_float16":
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    assert generator.get_layer("pre-cbr-1").compute_dtype == policy[6:]
+    before = generator.get_layer("output").get_weights()[0]
+    step = build_gan_step(generator, optimizer, 4, False, return_generated=True)
+    loss, generated = step(hazel, hazel)
+    assert loss.dtype == generated.dtype == tf.float32
+    assert np.isfinite(loss.numpy())
+    assert not np.allclose(generator.get_layer("output").get_weights()[0], before)
+
+
+def test_mirrored_step_matches_single_device():
+    rng = np.random.default_rng(0)
+    # Both replicas see the same samples, so their BatchNorm statistics agree
+    hazel = np.tile(rng.normal(size=(2, 32, 32, 1)).astype("float32"), (2, 1, 1, 1))
+    alder = np.tile(rng.normal(size=(2, 32, 32, 1)).astype("float32"), (2, 1, 1, 1))
+    weights = compile_generator(32, 32, 0, 0, define_filters("")).get_weights()
+    strategy = distribution_strategy("mirrored")
+    assert strategy.num_replicas_in_sync == 2
+    results = []
+    for distributed in (False, True):
+        with strategy.scope() if distributed else tf.distribute.get_strategy().scope():
+            generator = compile_generator(32, 32, 0, 0, define_filters(""))
+            generator.set_weights(weights)
+            optimizer = tf.keras.optimizers.Adam()
+        step = build_gan_step(
+            generator,
+            optimizer,
+            0,
+            False,
+            batch_size=4,
+            return_generated=True,
+            strategy=strategy if distributed else None,
+        )
+        loss, generated = step(hazel, alder)
+        results.append((loss.numpy(), generated.numpy(), generator.get_weights()[0]))
+    for single, mirrored in zip(*results):
+        np.testing.assert_allclose(single, mirrored, rtol=1e-4, atol=1e-5)
+
+
+def test_accumulated_step_matches_full_batch():
+    rng = np.random.default_rng(0)
+    # Identical micro-batches, so their BatchNorm statistics are the full batch's
+    hazel = rng.normal(size=(2, 32, 32, 1)).astype("float32")
+    alder = rng.normal(size=(2, 32, 32, 1)).astype("float32")
+    weights = compile_generator(32, 32, 0, 0, define_filters("")).get_weights()
+    results = []
+    for accumulate_steps in (1, 2):
+        generator = compile_generator(32, 32, 0, 0, define_filters(""))
+        generator.set_weights(weights)
+        step = build_gan_step(
+            generator,
+            tf.keras.optimizers.Adam(),
+            0,
+            False,
+            accumulate_steps=accumulate_steps,
+        )
+        if accumulate_steps == 1:
+            step(np.concatenate([hazel, hazel]), np.concatenate([alder, alder]))
+        else:
+            step(hazel, alder)
+            np.testing.assert_array_equal(generator.get_weights()[0], weights[0])
+            step(hazel, alder)
+        results.append(generator.get_weights()[0])
+    np.testing.assert_allclose(results[0], results[1], rtol=1e-4, atol=1e-6)
+
+
+def test_recomputed_blocks_match_stored():
+    hazel = np.random.default_rng(0).normal(size=(2, 32, 32, 1)).astype("float32")
+    weights = compile_generator(32, 32, 0, 0, define_filters("")).get_weights()
+    results = []
+    for recompute in ((), ("cbr", "down", "up")):
+        generator = compile_generator(
+            32, 32, 0, 0, define_filters(""), recompute=recompute
+        )
+        generator.set_weights(weights)
+        step = build_gan_step(generator, tf.keras.optimizers.Adam(), 0, False)
+        step(hazel, hazel)
+        results.append(generator.get_weights())
+    for stored, recomputed in zip(*results):
+        np.testing.assert_allclose(stored, recomputed, rtol=1e-4, atol=1e-6)
+    clone = tf.keras.models.clone_model(generator)
+    assert clone.get_layer("down_1-down-recompute").layers[0].name == "down_1-down"
+
+
+def test_generator_accepts_any_domain_size():
+    generator = compile_generator(37, 45, 2, 4, define_filters(""))
+    assert generator.output_shape == (None, 37, 45, 1)
+    padded = generator.get_layer("inputs-pad").output_shape
+    assert padded[1:3] == (64, 64)
+    image = np.random.default_rng(0).normal(size=(1, 37, 45, 1)).astype("float32")
+    # The padding reflects the fields without repeating the edge
+    np.testing.assert_array_equal(
+        generator.get_layer("inputs-pad")(image)[0, :13, 9, 0],
+        image[0, 13:0:-1, 0, 0],
+    )
+    # Too small to reflect into 64 x 64
+    hazel = np.ones((2, 10, 12, 1), "float32")
+    generator = compile_generator(10, 12, 0, 0, define_filters(""))
+    assert generator.get_layer("inputs-pad")(hazel).numpy().sum() == 2 * 10 * 12
+    step = build_gan_step(generator, tf.keras.optimizers.Adam(), 0, False)
+    assert np.isfinite(step(hazel, hazel).numpy())
+
+
+def test_noise_modes():
+    hazel = np.ones((2, 64, 64, 1), dtype="float32")
+    params = {}
+    for mode in ("dense", "channel", "spatial"):
+        generator = compile_generator(64, 64, 0, 4, define_filters(""), noise_mode=mode)
+        params[mode] = generator.count_params()
+        step = build_gan_step(generator, tf.keras.optimizers.Adam(), 4, False)
+        assert np.isfinite(step(hazel, hazel).numpy())
+    assert noise_shape(generator) == (2, 2, 4)
+    assert params["spatial"] < params["channel"] < params["dense"]
+    with pytest.raises(ValueError):
+        compile_generator(32, 32, 0, 4, define_filters(""), noise_mode="sparse")
+
+
+def test_spectral_normalization():
+    hazel = np.random.default_rng(0).normal(size=(2, 32, 32, 1)).astype("float32")
+    wrapper = SpectralNormalization(layers.Conv2D(4, 3), iterations=50)
+    wrapper(hazel, training=True)
+    matrix = wrapper.kernel_normalized.numpy().reshape(-1, 4)
+    np.testing.assert_allclose(np.linalg.svd(matrix)[1][0], 1, rtol=1e-3)
+    # Outside training u is kept and the cached kernel used
+    u = wrapper.u.numpy()
+    wrapper.layer.kernel.assign(2 * wrapper.layer.kernel)
+    np.testing.assert_allclose(
+        wrapper(hazel, training=False),
+        tf.nn.conv2d(hazel, wrapper.kernel_normalized, 1, "VALID"),
+        rtol=1e-5,
+        atol=1e-6,
+    )
+    np.testing.assert_array_equal(wrapper.u.numpy(), u)
+
+    generator = compile_generator(
+        32, 32, 0, 0, define_filters(""), spectral_norm=("cbr", "down", "up")
+    )
+    kernel = generator.get_layer("down_1-down").layers[0].kernel_normalized.numpy()
+    step = build_gan_step(generator, tf.keras.optimizers.Adam(), 0, False)
+    # Normalised again in the next training step, after the update
+    for _ in range(2):
+        assert np.isfinite(step(hazel, hazel).numpy())
+    assert not np.allclose(
+        generator.get_layer("down_1-down").layers[0].kernel_normalized.numpy(), kernel
+    )
+    clone = tf.keras.models.clone_model(generator)
+    assert len(clone.weights) == len(generator.weights)
+    with pytest.raises(ValueError):
+        compile_generator(
+            32, 32, 0, 0, define_filters(""), recompute=("up",), spectral_norm=("up",)
+        )
+
+
+@pytest.mark.parametrize(
+    "variant",
+    [
+        {"separable": True},
+        {"upsample": "resize"},
+        {"separable": True, "upsample": "resize", "width_multiplier": 0.5},
+    ],
+)
+def test_cheap_generator_variants(variant):
+    hazel = np.random.default_rng(0).normal(size=(2, 37, 45, 1)).astype("float32")
+    params = compile_generator(37, 45, 0, 0, define_filters("")).count_params()
+    generator = compile_generator(37, 45, 0, 0, define_filters(""), **variant)
+    assert generator.output_shape == (None, 37, 45, 1)
+    assert generator.count_params() < params
+    step = build_gan_step(generator, tf.keras.optimizers.Adam(), 0, False)
+    assert np.isfinite(step(hazel, hazel).numpy())
+    with pytest.raises(ValueError):
+        compile_generator(
+            37, 45, 0, 0, define_filters(""), spectral_norm=("cbr",), separable=True
+        )
+
+
+class Stop(Exception):
+    """Raised by the stub Tune session to end a trial."""
+
+
+def pollen_data(timesteps):
+    rng = np.random.default_rng(timesteps)
+    return xr.Dataset(
+        {
+            param: (
+                ("valid_time", "y", "x"),
+                rng.normal(size=(timesteps, 32, 32)).astype("float32"),
+            )
+            for param in select_params
+        },
+        coords={
+            "valid_time": pd.date_range("2022-03-01", periods=timesteps, freq="3600s"),
+            "pollen_mean": ("valid_time", rng.uniform(0, 50, timesteps)),
+        },
+    )
+
+
+@pytest.fixture(name="trial")
+def fixture_trial(monkeypatch):
+    """Run ``train_model`` outside Ray Tune until its ``reports``-th report.
+
+    Returns the reported metrics and checkpoints; ``resume`` is the checkpoint the
+    trial is restored from.
+    """
+
+    def run(generator, run_path, reports, resume=None, shuffle=False, **kwargs):
+        reported = []
+
+        def report(metrics, checkpoint=None):
+            reported.append((metrics, checkpoint))
+            if len(reported) == reports:
+                raise Stop
+
+        monkeypatch.setattr(
+            "aldernet.training_utils.air",
+            SimpleNamespace(
+                session=SimpleNamespace(report=report, get_checkpoint=lambda: resume),
+                Checkpoint=SimpleNamespace(
+                    from_directory=lambda path: SimpleNamespace(
+                        to_directory=lambda: path
+                    )
+                ),
+            ),
+        )
+        monkeypatch.setattr(
+            "aldernet.training_utils.tune",
+            SimpleNamespace(get_trial_name=lambda: "trial"),
+        )
+        monkeypatch.setattr(
+            "aldernet.training_utils.mlflow",
+            SimpleNamespace(
+                set_tracking_uri=lambda uri: None, set_experiment=lambda name: None
+            ),
+        )
+        config = {"learning_rate": 1e-3, "beta_1": 0.9, "beta_2": 0.999}
+        with pytest.raises(Stop):
+            train_model(
+                {**config, "batch_size": 8},
+                generator,
+                pollen_data(40),
+                pollen_data(24),
+                str(run_path),
+                0,
+                False,
+                shuffle,
+                **kwargs,
+            )
+        return reported
+
+    return run
+
+
+def test_train_model_reports(trial, tmp_path):
+    generator = compile_generator(32, 32, 0, 0, define_filters(""), context=2)
+    # 39 context windows give 4 batches per epoch
+    reported = trial(
+        generator,
+        tmp_path,
+        reports=6,
+        context=2,
+        eval_every_steps=3,
+        checkpoint_every=2,
+        viz_mode="sheet",
+        viz_samples=4,
+    )
+    # Every third step and at the end of each epoch, unless just reported
+    assert [metrics["iterations"] for metrics, _ in reported] == [3, 4, 6, 8, 9, 12]
+    epochs = [metrics["epoch"] for metrics, _ in reported]
+    assert epochs == [0.75, 1, 1.5, 2, 2.25, 3]
+    for metrics, _ in reported:
+        assert set(metrics) == {
+            "L1",
+            "L2",
+            "Bias",
+            "L1_valid",
+            "L2_valid",
+            "Bias_valid",
+            "iterations",
+            "epoch",
+            "Loss",
+            "Loss_valid",
+        }
+        assert np.isfinite(list(metrics.values())).all()
+    assert [checkpoint is not None for _, checkpoint in reported] == [False, True] * 3
+    # The trial stopped in the third epoch, before its sheet
+    sheets = tmp_path / "viz" / "sheets" / "trial"
+    assert sorted(path.name for path in sheets.iterdir()) == ["1.png", "2.png"]
+
+
+@pytest.mark.parametrize("sampling", [{"shuffle": True}, {"importance_exponent": 1.0}])
+def test_train_model_resumes_mid_epoch(trial, tmp_path, sampling):
+    weights = compile_generator(32, 32, 0, 0, define_filters("")).get_weights()
+
+    def generator():
+        model = compile_generator(32, 32, 0, 0, define_filters(""))
+        model.set_weights(weights)
+        return model
+
+    # 5 batches per epoch, the third report is in the middle of the second
+    kwargs = dict(eval_every_steps=3, viz_every_steps=0, **sampling)
+    full = trial(generator(), tmp_path / "full", reports=5, **kwargs)
+    stopped = trial(generator(), tmp_path / "stopped", reports=3, **kwargs)
+    assert [metrics["iterations"] for metrics, _ in full] == [3, 5, 6, 9, 10]
+    resumed = trial(
+        generator(), tmp_path / "resumed", reports=2, resume=stopped[-1][1], **kwargs
+    )
+    for (expected, _), (metrics, _) in zip(full[3:], resumed):
+        assert metrics.keys() == expected.keys()
+        for key, value in expected.items():
+            np.testing.assert_allclose(metrics[key], value, rtol=1e-4, err_msg=key)
+
+
+def test_train_model_redraws_importance_samples(trial, tmp_path, monkeypatch):
+    draws = []
+    on_epoch_end = Batcher.on_epoch_end
+
+    def record(self, seed=None):
+        on_epoch_end(self, seed)
+        if self.sample_probs is not None:
+            draws.append(self.order.copy())
+
+    monkeypatch.setattr(Batcher, "on_epoch_end", record)
+    generator = compile_generator(32, 32, 0, 0, define_filters(""))
+    trial(generator, tmp_path, reports=2, importance_exponent=1.0, viz_every_steps=0)
+    # Drawn on construction, then again for each of the two epochs
+    assert len(draws) == 3
+    assert not np.array_equal(draws[1], draws[2])
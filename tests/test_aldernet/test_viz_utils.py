@@ -0,0 +1,89 @@
+"""Test module ``aldernet/viz_utils.py``."""
+# Standard library
+import io
+
+# Third-party
+import matplotlib.pyplot as plt  # type: ignore
+import numpy as np
+
+# First-party
+from aldernet.viz_utils import contact_sheet  # type: ignore
+from aldernet.viz_utils import encode_png  # type: ignore
+from aldernet.viz_utils import render_triptychs  # type: ignore
+from aldernet.viz_utils import VIRIDIS  # type: ignore
+from aldernet.viz_utils import VizWriter  # type: ignore
+
+
+def test_triptychs_share_scale_without_overflow():
+    rng = np.random.default_rng(0)
+    inputs, targets = rng.normal(size=(2, 4, 6, 8, 1))
+    predictions = targets * 100.0
+    rgb = render_triptychs(inputs, targets, predictions, gap=2)
+    assert rgb.shape == (4, 6, 3 * 8 + 2 * 2, 3) and rgb.dtype == np.uint8
+    assert (rgb[:, :, 8:10] == 255).all()
+    for sample, prediction in zip(rgb, predictions):
+        # The extremes of each triptych hit the ends of the colormap
+        panel = sample[:, 20:]
+        np.testing.assert_array_equal(
+            panel[np.unravel_index(prediction.argmax(), prediction.shape[:2])],
+            VIRIDIS[-1],
+        )
+        np.testing.assert_array_equal(
+            panel[np.unravel_index(prediction.argmin(), prediction.shape[:2])],
+            VIRIDIS[0],
+        )
+
+
+def test_encode_png_round_trip():
+    rgb = np.random.default_rng(0).integers(0, 256, (5, 7, 3), dtype=np.uint8)
+    decoded = plt.imread(io.BytesIO(encode_png(rgb)), format="png")
+    np.testing.assert_array_equal((decoded * 255).round().astype(np.uint8), rgb)
+
+
+def test_viz_writer_cadence_and_layout(tmp_path):
+    writer = VizWriter(tmp_path, per_epoch=3)
+    try:
+        assert [b for b in range(10) if writer.due(b, b, 10)] == [0, 4, 9]
+        image = [np.random.default_rng(0).random((6, 8, 1))] * 3
+        writer.submit(image, 1, "4")
+    finally:
+        writer.close()
+    assert (tmp_path / "1" / "4.png").exists()
+    writer = VizWriter(tmp_path, every_steps=5)
+    writer.close()
+    assert [s for s in range(12) if writer.due(s, 0, 1)] == [0, 5, 10]
+
+
+def test_viz_writer_survives_failures(tmp_path):
+    writer = VizWriter(tmp_path, timeout=5)
+    # A task that fails is skipped and the following ones are still written
+    writer.submit(None, 1, "broken")
+    writer.submit([np.zeros((6, 8, 1))] * 3, 1, "0")
+    writer.close()
+    assert not writer.process.is_alive()
+    assert sorted(path.name for path in (tmp_path / "1").iterdir()) == ["0.png"]
+    # Closing after the worker died returns without waiting for it
+    writer = VizWriter(tmp_path, timeout=5, gif=True)
+    writer.submit_sheet(*np.zeros((3, 1, 6, 8, 1)), 2)
+    writer.process.kill()
+    writer.process.join()
+    writer.submit_sheet(*np.zeros((3, 1, 6, 8, 1)), 3)
+    writer.close()
+    assert writer.dropped == 1 and writer.sheets == [str(tmp_path / "2.png")]
+
+
+def test_contact_sheets_and_gif(tmp_path):
+    rgb = np.zeros((5, 6, 8, 3), np.uint8)
+    sheet = contact_sheet(rgb, columns=3, gap=2)
+    assert sheet.shape == (2 * 6 + 2, 3 * 8 + 2 * 2, 3)
+    assert (sheet[8:, 20:] == 255).all()
+    fields = np.random.default_rng(0).random((3, 5, 6, 8, 1))
+    writer = VizWriter(tmp_path, columns=3, gif=True)
+    for epoch in (1, 2):
+        writer.submit_sheet(*fields, epoch)
+    writer.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "1.png",
+        "2.png",
+        "sheets.gif",
+    ]